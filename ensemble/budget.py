@@ -0,0 +1,66 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import logging
+import threading
+import time
+
+module_name = 'Ensemble.budget'
+module_logger = logging.getLogger(module_name)
+
+class MemoryBudget(object):
+    """ Process-wide memory budget shared by all loaders
+
+    Loaders reserve an estimated number of bytes before fetching a batch
+    and release it once the batch has been loaded, so the combined size of
+    the batches held by all loaders stays under max_bytes.
+
+    """
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: total bytes that can be reserved at once
+        """
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def reserve(self, nbytes, min_bytes=0, timeout=None):
+        """ Reserve up to nbytes from the budget
+
+        If less than nbytes is free, whatever is free is reserved as long as
+        it is at least min_bytes, otherwise this blocks until it is.
+
+        :param nbytes: bytes wanted
+        :param min_bytes: smallest reservation worth having
+        :param timeout: seconds to wait for min_bytes, None waits forever
+        :returns: bytes reserved, 0 if timed out
+        """
+        nbytes = min(nbytes, self.max_bytes)
+        min_bytes = min(min_bytes, nbytes)
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.max_bytes - self.used < max(min_bytes, 1):
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return 0
+                self.cond.wait(remaining)
+            granted = min(nbytes, self.max_bytes - self.used)
+            self.used += granted
+            return granted
+
+    def release(self, nbytes):
+        """ Return reserved bytes to the budget
+
+        :param nbytes: bytes previously returned by reserve
+        """
+        with self.cond:
+            self.used = max(0, self.used - nbytes)
+            self.cond.notify_all()
+
+    def utilisation(self):
+        """ Fraction of the budget currently reserved """
+        return float(self.used) / self.max_bytes
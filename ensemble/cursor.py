@@ -0,0 +1,77 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import datetime
+import json
+import logging
+import os
+
+from helpers import write_atomic
+
+module_name = 'Ensemble.cursor'
+module_logger = logging.getLogger(module_name)
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+class WindowCursor(object):
+    """ Composite (TIME_STAMP, sequence number) checkpoint for loaders
+        that page through time windows
+
+    Rows are read in (TIME_STAMP, sequence number) order, so the position
+    of the last row loaded is where the next page starts. The position
+    only moves forward.
+
+    Rows loaded lately are remembered, and persisted with the position,
+    so rows that are read again, e.g. in an overlap, aren't loaded twice
+    even across a restart.
+
+    """
+    def __init__(self, path=None):
+        """
+        :param path: file to persist the position to, not persisted if None
+        """
+        self.path = path
+        self.position = None # (timestamp, seq)
+        self.recent = set() # (timestamp, seq) of rows loaded lately
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.position = (datetime.datetime.strptime(state['TIME_STAMP'],
+                                                        TIMESTAMP_FORMAT),
+                            state['seq'])
+            self.recent = set((datetime.datetime.strptime(timestamp,
+                                                        TIMESTAMP_FORMAT), seq)
+                            for timestamp, seq in state.get('recent', []))
+
+    def advance(self, timestamp, seq):
+        """ Move the position forward
+
+        :returns: True if the position moved
+        """
+        if self.position is not None and (timestamp, seq) <= self.position:
+            return False
+        self.position = (timestamp, seq)
+        return True
+
+    def remember(self, keys):
+        """ Record rows as loaded
+
+        :param keys: list of (timestamp, seq) tuples
+        """
+        self.recent.update(keys)
+
+    def forget(self, before):
+        """ Stop remembering rows with timestamps before a time """
+        self.recent = set(k for k in self.recent if k[0] >= before)
+
+    def save(self):
+        """ Persist the position and recent rows so they survive a restart
+        """
+        if not self.path or self.position is None:
+            return
+        write_atomic(self.path, json.dumps({
+                'TIME_STAMP': self.position[0].strftime(TIMESTAMP_FORMAT),
+                'seq': self.position[1],
+                'recent': sorted([timestamp.strftime(TIMESTAMP_FORMAT), seq]
+                                for timestamp, seq in self.recent)}))
@@ -0,0 +1,132 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import logging
+import threading
+import time
+
+import sqlalchemy
+
+module_name = 'Ensemble.enrichment'
+module_logger = logging.getLogger(module_name)
+
+class DimensionCache(object):
+    """ In-memory copy of a dimension table, indexed on a key column
+
+    The sql must take a single sequence number parameter, like the loader
+    queries, and return rows ordered by sequence number. Every refresh
+    interval only rows after the last sequence number seen are fetched.
+    After ttl the whole table is reloaded so removed rows are dropped.
+
+    """
+    def __init__(self, name, engine, sql, key_field, seq_field='INSERT_SEQ',
+                    refresh=300, ttl=86400):
+        """
+        :param name: name of the dimension
+        :param engine: sqlalchemy engine object
+        :param sql: sql query returning the dimension rows
+        :param key_field: column to look rows up by
+        :param seq_field: column that corresponds to sequence num
+        :param refresh: seconds between incremental refreshes
+        :param ttl: seconds between full reloads
+        """
+        self.name = name
+        self.engine = engine
+        self.sql = sql
+        self.key_field = key_field
+        self.seq_field = seq_field
+        self.refresh = refresh
+        self.ttl = ttl
+        self.data = {}
+        self.seq = -1
+        self.loaded_at = 0
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("%s.%s" % (module_name, name))
+
+    def get(self, key):
+        """ Fields for a key, or None if the key isn't in the dimension """
+        return self.data.get(key)
+
+    def _fetch(self, seq):
+        rows = self.engine.execute(self.sql, (seq,)).fetchall()
+        fields = {}
+        for r in rows:
+            r = dict(r.items())
+            seq = max(seq, r.pop(self.seq_field, seq))
+            fields[r.pop(self.key_field)] = r
+        return fields, seq
+
+    def refresh_if_due(self, now=None):
+        """ Reload or refresh the cache if it is due. If another thread is
+            already refreshing, carry on with the current data, or wait for
+            it if nothing has been loaded yet so docs aren't sent without
+            enrichment
+        """
+        now = now or time.time()
+        if now - self.refreshed_at < self.refresh and \
+                now - self.loaded_at < self.ttl:
+            return
+        refreshed_at = self.refreshed_at
+        if not self.lock.acquire(not self.loaded_at):
+            return
+        try:
+            if self.refreshed_at != refreshed_at:
+                # Another thread refreshed, or tried to, while we waited
+                return
+            if now - self.loaded_at >= self.ttl:
+                data, self.seq = self._fetch(-1)
+                # Swap in the new dict so readers never see a partial load
+                self.data = data
+                self.loaded_at = now
+                self.logger.info("Loaded %d entries" % len(data))
+            else:
+                data, self.seq = self._fetch(self.seq)
+                self.data.update(data)
+                if data:
+                    self.logger.info("Refreshed %d entries" % len(data))
+            self.refreshed_at = now
+        except sqlalchemy.exc.SQLAlchemyError, err:
+            if self.loaded_at:
+                self.logger.error("Unable to refresh, using cached data : "
+                                "%s" % err)
+            else:
+                self.logger.error("Unable to load, docs won't be enriched "
+                                "until it loads : %s" % err)
+            # Don't retry on every batch while the DB is struggling
+            self.refreshed_at = now
+        finally:
+            self.lock.release()
+
+class Enricher(object):
+    """ Stamps fields from a dimension onto docs
+
+    Looks up the value of a doc field in a DimensionCache and copies the
+    dimension's fields onto the doc, optionally with a prefix.
+
+    """
+    def __init__(self, dimension, key_field, prefix=''):
+        """
+        :param dimension: DimensionCache to look up
+        :param key_field: doc field holding the dimension key
+        :param prefix: prefix for the names of the stamped fields
+        """
+        self.dimension = dimension
+        self.key_field = key_field
+        self.prefix = prefix
+
+    def refresh_if_due(self):
+        self.dimension.refresh_if_due()
+
+    def enrich(self, body):
+        """ Add dimension fields to body in place
+
+        :param body: doc dict
+        :returns: body
+        """
+        fields = self.dimension.get(body.get(self.key_field))
+        if fields:
+            for k, v in fields.iteritems():
+                body[self.prefix + k] = v
+        return body
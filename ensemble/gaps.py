@@ -0,0 +1,99 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import bisect
+import json
+import logging
+import os
+import time
+
+from helpers import write_atomic
+
+module_name = 'Ensemble.gaps'
+module_logger = logging.getLogger(module_name)
+
+class GapTracker(object):
+    """ Ranges of sequence numbers a loader has skipped over
+
+    Identity values from transactions that commit late show up below the
+    loader's high water mark and would never be loaded. Gaps in the
+    sequence numbers fetched are remembered as [start, end] ranges so they
+    can be fetched again until the rows turn up or the gap is old enough
+    that it is assumed to be a real hole (rollback, identity cache jump).
+
+    Only track gaps for queries that return every sequence number that
+    commits. Rows left out by the query's own filters would look like
+    gaps that never fill.
+
+    """
+    def __init__(self, path=None, max_age=3600, max_gaps=1000):
+        """
+        :param path: file to persist gaps to, not persisted if None
+        :param max_age: seconds to keep a gap open before giving up on it
+        :param max_gaps: most gaps to track, the oldest are dropped first
+        """
+        self.path = path
+        self.max_age = max_age
+        self.max_gaps = max_gaps
+        self.gaps = [] # sorted list of [start, end, first seen]
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                self.gaps = json.load(f)
+
+    def __len__(self):
+        return len(self.gaps)
+
+    def __iter__(self):
+        """ Iterate over (start, end) of open gaps """
+        return iter([(g[0], g[1]) for g in self.gaps])
+
+    def observe(self, last_seq, seqs, now=None):
+        """ Record the gaps in a page of sequence numbers
+
+        :param last_seq: high water mark before the page was fetched
+        :param seqs: ascending sequence numbers fetched
+        :returns: number of new gaps
+        """
+        now = now or time.time()
+        new = []
+        prev = last_seq
+        for seq in seqs:
+            if seq > prev + 1:
+                new.append([prev + 1, seq - 1, now])
+            prev = max(prev, seq)
+        if new:
+            self.gaps = sorted(self.gaps + new)[-self.max_gaps:]
+        return len(new)
+
+    def fill(self, seqs):
+        """ Close up the gaps for sequence numbers that have been found
+
+        :param seqs: sequence numbers found
+        """
+        for seq in seqs:
+            # Last gap starting at or before seq
+            i = bisect.bisect_right(self.gaps, [seq, float('inf')]) - 1
+            if i < 0:
+                continue
+            start, end, seen = self.gaps[i]
+            if seq <= end:
+                split = [[start, seq - 1, seen], [seq + 1, end, seen]]
+                self.gaps[i:i + 1] = [g for g in split if g[0] <= g[1]]
+
+    def expire(self, now=None):
+        """ Stop tracking gaps older than max_age
+
+        :returns: list of (start, end) gaps given up on
+        """
+        now = now or time.time()
+        expired = [(g[0], g[1]) for g in self.gaps
+                    if now - g[2] >= self.max_age]
+        self.gaps = [g for g in self.gaps if now - g[2] < self.max_age]
+        return expired
+
+    def save(self):
+        """ Persist gaps so they survive a restart """
+        if not self.path:
+            return
+        write_atomic(self.path, json.dumps(self.gaps))
@@ -0,0 +1,147 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import logging
+import threading
+import time
+import heapq
+import itertools
+
+import elasticsearch.exceptions
+
+module_name = 'Ensemble.governor'
+module_logger = logging.getLogger(module_name)
+# Most bulk requests in flight, unless configured otherwise
+DEFAULT_MAX_LIMIT = 16
+
+class BackpressureGovernor(object):
+    """ Limits bulk requests in flight across all loaders
+
+    The limit grows by one request per round of requests that come back
+    quickly and without rejections, and is cut by a factor when bulk
+    latency goes above target, items are rejected, or the nodes' bulk
+    thread pool queues fill up (AIMD). That keeps the cluster near the
+    most it can take instead of all loaders backing off and piling back
+    in together.
+
+    When loaders are waiting, permits are shared out in proportion to
+    their weights, so a loader with weight 2 gets twice the requests of a
+    loader with weight 1 without starving it.
+
+    """
+    def __init__(self, es=None, initial=4, min_limit=1,
+                    max_limit=DEFAULT_MAX_LIMIT,
+                    target_latency=2.0, decrease=0.5, stats_interval=0,
+                    max_queue=50):
+        """
+        :param es: Elasticsearch connection object, used for node stats
+        :param initial: number of requests allowed in flight to start with
+        :param min_limit: fewest requests allowed in flight
+        :param max_limit: most requests allowed in flight
+        :param target_latency: seconds a bulk request should take at most
+        :param decrease: factor to cut the limit by when overloaded
+        :param stats_interval: seconds between checks of the nodes' bulk
+            thread pools, 0 disables the checks
+        :param max_queue: bulk thread pool queue length that counts as
+            overloaded
+        """
+        self.es = es
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.stats_interval = stats_interval
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.waiting = [] # heap of (finish tag, ticket)
+        self.tickets = itertools.count()
+        self.virtual_time = 0.0
+        self.last_tags = {} # loader name -> last finish tag
+        self.last_decrease = 0
+        self.stats_checked = 0
+        self.stats_lock = threading.Lock()
+        self.rejected = None
+
+    def acquire(self, name, weight=1):
+        """ Block until the loader may send a bulk request
+
+        :param name: loader name
+        :param weight: loader's share of requests under contention
+        """
+        self._check_thread_pools()
+        with self.cond:
+            # Weighted fair queueing: each request is tagged with when it
+            # would finish if every loader got its share, earliest goes first
+            tag = max(self.virtual_time, self.last_tags.get(name, 0)) + \
+                    1.0 / weight
+            self.last_tags[name] = tag
+            entry = (tag, next(self.tickets))
+            heapq.heappush(self.waiting, entry)
+            while self.in_flight >= int(self.limit) or \
+                    self.waiting[0] != entry:
+                # Wait with a timeout so signals are still handled
+                self.cond.wait(1)
+            heapq.heappop(self.waiting)
+            self.virtual_time = tag
+            self.in_flight += 1
+            self.cond.notify_all()
+
+    def release(self, latency, rejected=False):
+        """ Give back a permit and adjust the limit
+
+        :param latency: seconds the bulk request took
+        :param rejected: True if any items were rejected as ES was busy
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if rejected or latency > self.target_latency:
+                self._decrease("rejections" if rejected else
+                                "latency %.1fs" % latency)
+            else:
+                self.limit = min(self.max_limit,
+                                self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def _decrease(self, reason):
+        # Requests in flight when the cluster got busy will all come back
+        # slow, so only cut the limit once per target latency
+        now = time.time()
+        if now - self.last_decrease < self.target_latency:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        module_logger.info("Bulk limit cut to %d due to %s" %
+                            (int(self.limit), reason))
+
+    def _check_thread_pools(self):
+        """ Cut the limit if the nodes' bulk queues are filling up or they
+            have started rejecting requests
+        """
+        if not self.es or not self.stats_interval or \
+                time.time() - self.stats_checked < self.stats_interval:
+            return
+        if not self.stats_lock.acquire(False):
+            return
+        try:
+            self.stats_checked = time.time()
+            stats = self.es.nodes.stats(metric='thread_pool')
+            bulk = [n['thread_pool']['bulk']
+                    for n in stats['nodes'].itervalues()]
+            queue = max(b['queue'] for b in bulk)
+            rejected = sum(b['rejected'] for b in bulk)
+            with self.cond:
+                if queue > self.max_queue:
+                    self._decrease("bulk queue length %d" % queue)
+                elif self.rejected is not None and rejected > self.rejected:
+                    self._decrease("%d bulk thread pool rejections" %
+                                    (rejected - self.rejected))
+            self.rejected = rejected
+        except (elasticsearch.exceptions.TransportError, KeyError,
+                ValueError), err:
+            module_logger.warning("Unable to check bulk thread pools : %s" %
+                                    err)
+        finally:
+            self.stats_lock.release()
@@ -1,8 +1,135 @@
 import logging
+import os
 import urllib
+import gzip
+import threading
+import contextlib
+from cStringIO import StringIO
+
 import sqlalchemy
+import urllib3
 from elasticsearch import Elasticsearch, TransportError, ConnectionError
+from elasticsearch import Urllib3HttpConnection, RoundRobinSelector
+
+class TransportStats(object):
+    """ Request body bytes sent to Elasticsearch, before and after
+        compression, per loader
+
+    Requests are counted against the name the sending thread is tagged
+    with, or None for untagged requests like searches at startup.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counts = {} # name -> [requests, raw bytes, compressed bytes]
+
+    @contextlib.contextmanager
+    def tagged(self, name):
+        """ Count requests sent by this thread against name """
+        previous = getattr(self.local, 'name', None)
+        self.local.name = name
+        try:
+            yield
+        finally:
+            self.local.name = previous
+
+    def add(self, raw, compressed):
+        name = getattr(self.local, 'name', None)
+        with self.lock:
+            counts = self.counts.setdefault(name, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += raw
+            counts[2] += compressed
+
+    def get(self, name):
+        """ :returns: tuple of requests, raw bytes and compressed bytes """
+        with self.lock:
+            return tuple(self.counts.get(name, (0, 0, 0)))
+
+transport_stats = TransportStats()
+
+class CompressedHttpConnection(Urllib3HttpConnection):
+    """ Keep-alive connection that gzips request bodies and counts the
+        bytes sent in transport_stats
+
+    Bulk bodies are mostly repeated field names and compress well, which
+    matters when Elasticsearch is across a slow link. Responses are asked
+    for gzipped too; urllib3 decompresses them.
+
+    """
+    def __init__(self, compress=False, compress_level=6, **kwargs):
+        """
+        :param compress: gzip request bodies
+        :param compress_level: gzip level, 1 is fastest
+        """
+        self.compress = compress
+        self.compress_level = compress_level
+        self.local = threading.local()
+        super(CompressedHttpConnection, self).__init__(**kwargs)
+        if compress:
+            self._headers.update(urllib3.make_headers(accept_encoding=True))
+
+    # The parent sends self.headers with every request, so the
+    # Content-Encoding header is added only while sending a gzipped body
+    @property
+    def headers(self):
+        if getattr(self.local, 'raw_body', None) is not None:
+            return dict(self._headers, **{'content-encoding': 'gzip'})
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        if body is None:
+            return super(CompressedHttpConnection, self).perform_request(
+                        method, url, params, body, timeout, ignore)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        raw_body = body
+        if self.compress:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb',
+                                compresslevel=self.compress_level) as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.local.raw_body = raw_body
+        transport_stats.add(len(raw_body), len(body))
+        try:
+            return super(CompressedHttpConnection, self).perform_request(
+                        method, url, params, body, timeout, ignore)
+        finally:
+            self.local.raw_body = None
+
+    # Log the body as it was before it was gzipped
+    def log_request_success(self, method, full_url, path, body, *args):
+        body = getattr(self.local, 'raw_body', None) or body
+        super(CompressedHttpConnection, self).log_request_success(method,
+                full_url, path, body, *args)
+
+    def log_request_fail(self, method, full_url, body, *args, **kwargs):
+        body = getattr(self.local, 'raw_body', None) or body
+        super(CompressedHttpConnection, self).log_request_fail(method,
+                full_url, body, *args, **kwargs)
    
+def write_atomic(path, data):
+    """ Write data to a file so readers see the old or the new contents,
+        never a partial write
+
+    :param path: file to write
+    :param data: string to write
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
 def get_db_engine(host, port, db_name, user, passwd):
     """ Get sqlalchemy engine from setup config
 
@@ -31,13 +158,20 @@ def get_db_engine(host, port, db_name, user, passwd):
             'mssql+pyodbc:///?odbc_connect=%s' % (urllib.quote_plus(c)))
 
 def get_es_conn(es_hostlist=None, es_user=None, es_pass=None, ssl=False,
-        verify_certs=False, cacerts_path=None):
+        verify_certs=False, cacerts_path=None, compress=False, maxsize=10,
+        sniff=True, timeout=10):
     """ Returns an elasticsearch obj using config from setup
 
     :param es_hostlist: list of node hostnames in Elasticsearch cluster
     :param ssl: Enable SSL (defaults to False) 
     :param verify_certs:  verify SSL certs
     :param cacerts_path: path to CA certificates
+    :param compress: gzip request bodies
+    :param maxsize: keep-alive connections to keep open per host, should
+        be at least the number of bulk requests in flight
+    :param sniff: discover the cluster's nodes on start and when a node
+        fails, otherwise requests go round robin to es_hostlist only
+    :param timeout: seconds to wait for a response
     :param logger_name: optional name of logger
     :returns: Elasticsearch object 
 
@@ -48,6 +182,11 @@ def get_es_conn(es_hostlist=None, es_user=None, es_pass=None, ssl=False,
         return False
     assert(type(es_hostlist) == list)
 
+    transport = dict(connection_class=CompressedHttpConnection,
+                    compress=compress,
+                    maxsize=maxsize,
+                    timeout=timeout,
+                    selector_class=RoundRobinSelector)
     try:
         if ssl:
             es = Elasticsearch(
@@ -55,8 +194,9 @@ def get_es_conn(es_hostlist=None, es_user=None, es_pass=None, ssl=False,
                     http_auth=(es_user, es_pass),
                     use_ssl=True,
                     verify_certs=verify_certs,
-                    cacerts=cacerts_path)
-        else:
+                    cacerts=cacerts_path,
+                    **transport)
+        elif sniff:
             es = Elasticsearch(
                     es_hostlist,
                     http_auth=(es_user, es_pass),
@@ -65,7 +205,13 @@ def get_es_conn(es_hostlist=None, es_user=None, es_pass=None, ssl=False,
                     # refresh nodes after a node fails to respond
                     sniff_on_connection_fail=True,
                     # and also every 60 seconds
-                    sniffer_timeout=60)
+                    sniffer_timeout=60,
+                    **transport)
+        else:
+            es = Elasticsearch(
+                    es_hostlist,
+                    http_auth=(es_user, es_pass),
+                    **transport)
     except TransportError, ConnectionError:
         return False
 
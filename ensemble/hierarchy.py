@@ -0,0 +1,75 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import logging
+
+module_name = 'Ensemble.hierarchy'
+module_logger = logging.getLogger(module_name)
+
+def split_path(consumer):
+    """ Split a consumer path like /Root/BU/App into its parts """
+    return [p for p in consumer.split('/') if p]
+
+class ConsumerNode(object):
+    """ Node of a ConsumerTree, one per consumer path """
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = None
+
+class ConsumerTree(object):
+    """ Prefix tree that totals consumer values up the consumer hierarchy
+
+    Rows are added one at a time, per sample, in a single pass. Totals for
+    every ancestor of the consumers are then worked out from the leaves
+    up. Only leaf consumers are counted, so a parent consumer with its own
+    row isn't counted twice.
+
+    """
+    def __init__(self, fields):
+        """
+        :param fields: names of the numeric fields to total
+        """
+        self.fields = fields
+        self.samples = {} # sample key -> root ConsumerNode
+
+    def add(self, sample, consumer, row):
+        """ Add a consumer's values for a sample. Adding the same consumer
+            again for a sample replaces its values.
+
+        :param sample: hashable key for the sample, e.g. a timestamp
+        :param consumer: consumer path
+        :param row: dict containing the fields to total
+        """
+        node = self.samples.setdefault(sample, ConsumerNode())
+        for part in split_path(consumer):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = ConsumerNode()
+            node = child
+        node.values = [row.get(f) or 0 for f in self.fields]
+
+    def totals(self, sample):
+        """ Totals for every consumer path in a sample
+
+        :param sample: sample key
+        :returns: list of (path, depth, number of leaf consumers, dict of
+            totals) tuples
+        """
+        results = []
+        def walk(node, parts):
+            if not node.children:
+                totals, leaves = node.values or [0] * len(self.fields), 1
+            else:
+                totals, leaves = [0] * len(self.fields), 0
+                for name, child in node.children.iteritems():
+                    child_totals, child_leaves = walk(child, parts + [name])
+                    totals = [a + b for a, b in zip(totals, child_totals)]
+                    leaves += child_leaves
+            results.append(('/' + '/'.join(parts), len(parts), leaves,
+                            dict(zip(self.fields, totals))))
+            return totals, leaves
+        walk(self.samples[sample], [])
+        return results
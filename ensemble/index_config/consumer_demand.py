@@ -2,6 +2,51 @@ config = {
     'template_name': 'consumer_demand',
     'all_index': 'consumer_demand',
     'index_rollover': 'daily', # Other option is monthly
+    # Totals per level of the consumer hierarchy at each sample, loaded into
+    # companion indices when the loader has rollup enabled. Named so the
+    # main template doesn't match them.
+    'rollup': {
+        'template_name': 'rollup_consumer_demand',
+        'all_index': 'rollup_consumer_demand',
+        'group_fields': ['CLUSTER_NAME'],
+        'fields': ['MAX_REQUESTED', 'USED'],
+        'template_body': {
+            'template': 'rollup_consumer_demand*',
+            'settings': {
+                "number_of_shards": 1,
+                "number_of_replicas": 1,
+            },
+            'aliases': {
+                "rollup_consumer_demand" : {},
+            },
+            'mappings': {
+                'default': {
+                    "properties": {
+                        "CLUSTER_NAME": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
+                        "CONSUMER_PATH": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
+                        "CONSUMER_PARENT": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
+                        "TIME_STAMP": {
+                            "type": "date",
+                            "format": "dateOptionalTime"
+                        },
+                        "CONSUMER_DEPTH": {"type": "integer"},
+                        "NUM_CONSUMERS": {"type": "integer"},
+                        "MAX_REQUESTED": {"type": "long"},
+                        "USED": {"type": "long"},
+                    }
+                }
+            }
+        }
+    },
     'template_body': {
         'template': 'consumer_demand*',
         'settings': {
@@ -2,6 +2,62 @@ config = {
     'template_name': 'consumer_resource_allocation',
     'all_index': 'consumer_resource_allocation',
     'index_rollover': 'daily', # Other option is monthly
+    # Totals per level of the consumer hierarchy at each sample, loaded into
+    # companion indices when the loader has rollup enabled. Named so the
+    # main template doesn't match them.
+    'rollup': {
+        'template_name': 'rollup_consumer_resource_allocation',
+        'all_index': 'rollup_consumer_resource_allocation',
+        'group_fields': ['CLUSTER_NAME', 'RESOURCE_GROUP'],
+        'fields': ['ALLOCATED_SHARE', 'ALLOCATED_OWN', 'ALLOCATED_BORROW',
+                   'ALLOCATED_LEND', 'USED', 'TOTAL_DEMAND',
+                   'UNSATISFIED_DEMAND'],
+        'template_body': {
+            'template': 'rollup_consumer_resource_allocation*',
+            'settings': {
+                "number_of_shards": 1,
+                "number_of_replicas": 1,
+            },
+            'aliases': {
+                "rollup_consumer_resource_allocation" : {},
+            },
+            'mappings': {
+                'default': {
+                    "properties": {
+                        "CLUSTER_NAME": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
+                        "RESOURCE_GROUP": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
+                        "CONSUMER_PATH": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
+                        "CONSUMER_PARENT": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
+                        "TIME_STAMP": {
+                            "type": "date",
+                            "format": "dateOptionalTime"
+                        },
+                        "CONSUMER_DEPTH": {"type": "integer"},
+                        "NUM_CONSUMERS": {"type": "integer"},
+                        "ALLOCATED_SHARE": {"type": "long"},
+                        "ALLOCATED_OWN": {"type": "long"},
+                        "ALLOCATED_BORROW": {"type": "long"},
+                        "ALLOCATED_LEND": {"type": "long"},
+                        "USED": {"type": "long"},
+                        "TOTAL_DEMAND": {"type": "long"},
+                        "UNSATISFIED_DEMAND": {"type": "long"},
+                    }
+                }
+            }
+        }
+    },
     'template_body': {
         'template': 'consumer_resource_allocation*',
         'settings': {
@@ -19,6 +19,8 @@ config = {
                             "type": "string",
                             "index": "not_analyzed"
                         },
+                        "AVG_SUBMIT2START_TIME": {"type": "double"},
+                        "AVG_TASK_RUNTIME": {"type": "double"},
                         "CLIENT_HOST_NAME": {"type": "string",},
                         "CLIENT_IP_ADDRESS": {"type": "string"},
                         "CLIENT_OS_USER_NAME": {
@@ -87,6 +89,7 @@ config = {
                         "SERVICE_INSTANCES": {"type":"integer"},
                         "SERVICE_TO_SLOT_RATIO": {"type":"string"},
                         "SESSION_BINDING_FAILURES": {"type":"string"},
+                        "SESSION_DURATION": {"type": "double"},
                         "SESSION_ID":{"type":"long"},
                         "SESSION_METADATA": {"type":"string"},
                         "SESSION_NAME": {"type":"string"},
@@ -114,6 +117,7 @@ config = {
                             "index": "not_analyzed"
                         },
                         "TASK_EXECUTION_TIMEOUT":{ "type": "integer"},
+                        "TASK_FAILURE_RATIO": {"type": "double"},
                         "TASK_RETRY_LIMIT": { "type": "long"},
                         "TIME_STAMP": {
                             "type": "date",
@@ -6,13 +6,36 @@ import logging
 import urllib
 import time
 import sys
+import os
+import hashlib
+import datetime
+import threading
+import re
 
 import sqlalchemy
 from elasticsearch import helpers
 from index_config.consumer_demand import config as consumer_demand_config
+from hierarchy import ConsumerTree
+from gaps import GapTracker
+from cursor import WindowCursor
+from sinks import get_records
+from helpers import transport_stats
 import elasticsearch.exceptions
 
 module_name = 'Ensemble.loader'
+# A fetched row is held as a RowProxy, a dict and a bulk action at once
+ROW_COPIES = 3
+# Row size estimate to use until we've measured a batch
+DEFAULT_ROW_BYTES = 2048
+# Bulk item statuses worth retrying - ES is busy rather than rejecting the doc
+RETRY_STATUSES = (429, 503, 'N/A')
+# Gaps fetched per query, SQL Server allows 2100 parameters
+GAP_RANGES_PER_QUERY = 100
+# Rollup samples totalled again per query
+SAMPLES_PER_QUERY = 100
+# Most bytes in one bulk request, ES rejects requests over
+# http.max_content_length
+BULK_MAX_BYTES = 100 * 1024 * 1024
 module_logger = logging.getLogger(module_name)
 
 # Elastic search loggers
@@ -23,9 +46,19 @@ class Loader(object):
     """ Base Loader class 
 
     """
+    # One doc per row, so row and doc counts can be reconciled
+    reconcile_counts = True
+
     def __init__(self, db_engine, es_conn, max_rows=2000, 
                     seq_field='INSERT_SEQ', sql='', doctype='',
-                    chunk_size=100, es_config=None):
+                    chunk_size=100, es_config=None, bulk_max_retries=3,
+                    bulk_retry_wait=1, dead_letter_dir=None,
+                    precreate_ahead=3600, precreate_timeout='30s',
+                    memory_budget=None, min_rows=100, enrichers=None,
+                    rollup=False, governor=None, bulk_weight=1,
+                    state_dir=None, gap_max_age=3600, sinks=None,
+                    cursor='seq', window_sql='', window_overlap=300,
+                    window_start=None, utc_timestamps=False):
         """ Constructor for a sqlloader object
         A loader class for a table an index
 
@@ -35,6 +68,47 @@ class Loader(object):
         :param seq_field: field in DB that corresponds to sequence num
         :param sql: sql query to run to retrieve records
         :param chunk_size: elasticsearch bulk insert chunk size
+        :param bulk_max_retries: times to resend items rejected by ES
+        :param bulk_retry_wait: initial seconds to wait before resending,
+            doubled on every retry
+        :param dead_letter_dir: directory for items that still fail after
+            all retries. Failed items are only logged if not set
+        :param precreate_ahead: seconds before the rollover boundary to
+            create the next index. 0 disables pre-creation
+        :param precreate_timeout: how long to wait for the shards of a
+            pre-created index to be allocated
+        :param memory_budget: MemoryBudget shared between loaders. Pages
+            are shrunk or delayed to stay within it
+        :param min_rows: smallest page to fetch when the budget is tight
+        :param enrichers: list of Enrichers that stamp dimension fields
+            onto each doc
+        :param rollup: also load totals per level of the consumer hierarchy
+            into the companion index in es_config['rollup']. Samples are
+            totalled from the rows in the DB, read with sql
+        :param governor: BackpressureGovernor shared between loaders that
+            hands out permits to send bulk requests
+        :param bulk_weight: loader's share of bulk requests when loaders
+            are contending for permits
+        :param state_dir: directory to persist loader state like gaps in
+            sequence numbers to
+        :param gap_max_age: seconds to keep re-fetching a gap in sequence
+            numbers before giving up on it. 0 disables gap tracking, which
+            is only worth having if sql doesn't filter out rows
+        :param sinks: list of Sinks to send a copy of the docs to, on top
+            of Elasticsearch
+        :param cursor: 'seq' to page through rows by sequence number with
+            sql, or 'time_window' to page through them a rollover period
+            at a time by (TIME_STAMP, sequence number) with window_sql
+        :param window_sql: sql taking (top, window start, window end,
+            timestamp, timestamp, sequence number) for rows in the window
+            after the given position, ordered by TIME_STAMP then sequence
+        :param window_overlap: seconds back from the last row loaded to
+            start reading again, to pick up rows that committed late
+        :param window_start: datetime to start loading from when there is
+            no checkpoint, defaults to the start of the current window
+        :param utc_timestamps: True if TIME_STAMP is in UTC rather than
+            local time. Index names come from TIME_STAMP, so rollover
+            periods are worked out on the same clock
         """
         self.engine = db_engine
         self.es = es_conn
@@ -43,19 +117,132 @@ class Loader(object):
         self.sql = sql
         self.chunk_size = chunk_size
         self.es_config = es_config
+        self.name = es_config['template_name']
         self.index_rollover = es_config['index_rollover']
+        self.bulk_max_retries = bulk_max_retries
+        self.bulk_retry_wait = bulk_retry_wait
+        self.dead_letter_dir = dead_letter_dir
+        self.precreate_ahead = precreate_ahead
+        self.precreate_timeout = precreate_timeout
+        self.utc_timestamps = utc_timestamps
+        # Indices we have created or seen, so we only ask ES once
+        self.known_indices = set()
+        self.memory_budget = memory_budget
+        self.min_rows = min(min_rows, max_rows)
+        self.row_bytes = DEFAULT_ROW_BYTES
+        self.enrichers = enrichers or []
+        self.rollup_config = es_config.get('rollup') if rollup else None
+        self.governor = governor
+        self.bulk_weight = bulk_weight
+        self.sinks = sinks or []
         
         # Initialise logging
         self.logger = logging.getLogger("%s.%s" % (module_name, 
                                                 es_config['template_name']))
 
-        # Create template if it doesn't exist
-        self._init_es(es_config)
+        # Rollup samples touched by docs loaded since they were last totalled
+        self.rollup_samples = set()
+        if self.rollup_config and not self._get_sample_sql(sql):
+            self.logger.error("Can't find '%s > ?' in SQL, not rolling up" %
+                                seq_field)
+            self.rollup_config = None
+
+        self.cursor = cursor
+        self.window_sql = window_sql
+        self.window_overlap = window_overlap
+        self.window_start = window_start
+        self.position = None
+        if cursor == 'time_window' and not window_sql:
+            self.logger.error("No window_sql, falling back to sequence "
+                                "numbers")
+            self.cursor = 'seq'
+        elif cursor == 'time_window':
+            self.position = WindowCursor(state_dir and
+                        os.path.join(state_dir, "%s.cursor.json" % self.name))
+
+        # Late committed rows are re-fetched from gaps in the sequence.
+        # Time windows pick them up with the overlap instead
+        self.gaps = None
+        if self.cursor == 'time_window':
+            gap_max_age = 0
+        if gap_max_age and self._get_range_sql(sql):
+            self.gaps = GapTracker(state_dir and
+                            os.path.join(state_dir, "%s.gaps.json" % self.name),
+                            max_age=gap_max_age)
+        elif gap_max_age:
+            self.logger.warning("Can't find '%s > ?' in SQL, not tracking "
+                                "gaps" % seq_field)
+
+        # Template and sequence number checks are deferred to initialise()
+        # so loaders can be built without waiting on Elasticsearch
+        self.seq = None
+        self.initialised = False
+        self.init_lock = threading.Lock()
+        # Sinks are caught up on the first load, not while initialising
+        self.sinks_caught_up = not self.sinks
+
+    def initialise(self):
+        """ Create the template if it doesn't exist and find where we left
+            off. Safe to call from several threads, the work is done once
+        """
+        with self.init_lock:
+            if self.initialised:
+                return
+            # Check the template while we look for the sequence number
+            errors = []
+            def init_template():
+                try:
+                    self._init_es(self.es_config)
+                    if self.rollup_config:
+                        self._init_es(self.rollup_config)
+                except Exception, err:
+                    errors.append(err)
+            template = threading.Thread(target=init_template)
+            template.start()
+            # We need to know where we left off by getting the largest
+            # sequence number in the index
+            seq = self._find_last_seq(self.es_config['all_index'])
+            template.join()
+            if errors:
+                raise errors[0]
+            self.seq = seq
+            self.logger.info("Last Sequence number = %d" % self.seq)
+            if self.position and self.position.position is None:
+                self._init_position()
+            for sink in self.sinks:
+                sink.start()
+            self.initialised = True
+
+    def _catch_up_sinks(self):
+        """ Send sinks the rows loaded into Elasticsearch after the last
+            batch they were sent, e.g. if the process was killed before it
+            could spool their queues. Batches already spooled aren't sent
+            again. New sinks start from where Elasticsearch is.
+
+            Called from load() before new rows are sent, so the sinks get
+            batches in order
+        """
+        if self.sinks_caught_up:
+            return
+        for sink in self.sinks:
+            if sink.sent is None or sink.sent >= self.seq:
+                continue
+            if not self._get_range_sql(self.sql):
+                self.logger.warning("%s is behind at %d but can't find "
+                                    "'%s > ?' in SQL to catch up" %
+                                    (sink, sink.sent, self.seq_field))
+                continue
+            self.logger.info("Catching up %s from %d" % (sink, sink.sent))
+            def send(sqldata):
+                sink.send(get_records(self._get_actions(sqldata)),
+                            sqldata[-1][self.seq_field])
+            self._load_range(sink.sent + 1, self.seq, send)
+        self.sinks_caught_up = True
 
-        # We need to know where we left off by getting the largest
-        # sequence number in the index
-        self.seq = self._find_last_seq(es_config['all_index'])
-        self.logger.info("Last Sequence number = %d" % self.seq)
+    def close(self):
+        """ Stop the sinks, keeping anything they haven't written """
+        for sink in self.sinks:
+            sink.close()
 
     def _init_es(self, cfg):
         if not cfg:
@@ -87,16 +274,188 @@ class Loader(object):
         else:
             return res["hits"]["hits"][0]["sort"][0]
     
-    def _runsql(self):
+    def _find_last_position(self, index_name):
+        """ Returns the (TIME_STAMP, sequence number) of the latest doc in
+            elastic search index
+
+        :returns: tuple of timestamp and sequence number, None if there
+            are no docs
+        """
+        search_body = {
+            "query": { "match_all": {}},
+            "size": 1,
+            "sort": [
+                {"TIME_STAMP": {"order": "desc"}},
+                {self.seq_field: {"order": "desc"}}
+            ]
+        }
+        try:
+            res = self.es.search(index=index_name, body=search_body)
+        except elasticsearch.exceptions.NotFoundError:
+            return None
+        hits = res["hits"]["hits"]
+        if not hits:
+            return None
+        # Dates sort as epoch milliseconds
+        timestamp, seq = hits[0]["sort"]
+        return (datetime.datetime.utcfromtimestamp(timestamp / 1000.0), seq)
+
+    def _init_position(self):
+        """ Start time windows from the latest doc in the index, or from
+            window_start if there are none
+        """
+        position = self._find_last_position(self.es_config['all_index'])
+        if position is None:
+            start = self.window_start or self._now()
+            if not isinstance(start, datetime.datetime):
+                # Dates from the config file
+                start = datetime.datetime.combine(start, datetime.time())
+            position = (self._window(start)[0], -1)
+        self.position.advance(*position)
+        self.logger.info("Starting time windows from %s, %d" % position)
+
+    def _now(self):
+        """ Current time on the same clock as TIME_STAMP """
+        if self.utc_timestamps:
+            return datetime.datetime.utcnow()
+        return datetime.datetime.now()
+
+    def _window(self, timestamp):
+        """ Return the start and end of the time window containing
+            timestamp. Windows are the index rollover periods, or days if
+            the index doesn't roll over
+        """
+        start = self._period_start(timestamp)
+        if start is None:
+            start = timestamp.replace(hour=0, minute=0, second=0,
+                                        microsecond=0)
+            return (start, start + datetime.timedelta(days=1))
+        return (start, self._next_period(timestamp))
+
+    def _get_range_sql(self, sql, ranges=1):
+        """ Turn the loader's 'sequence > ?' query into a 'sequence
+            between ? and ?' query for fetching ranges of rows
+
+        :param ranges: number of ranges to fetch in the one query
+        :returns: range query, None if sql isn't in the expected form
+        """
+        between = ' OR '.join([r'\1 BETWEEN ? AND ?'] * ranges)
+        if ranges > 1:
+            between = '(%s)' % between
+        # Table prefixes are part of the column, e.g. [T].[INSERT_SEQ]
+        range_sql, n = re.subn(r'((?:\[?\w+\]?\.)*\[?%s\]?)\s*>\s*\?' %
+                                self.seq_field, between, sql, flags=re.I)
+        return range_sql if n == 1 else None
+
+    def _get_sample_sql(self, sql, samples=1):
+        """ Turn the loader's 'sequence > ?' query into a 'TIME_STAMP in
+            (?, ...) and sequence > ?' query for paging through the rows of
+            rollup samples
+
+        :param samples: number of sample timestamps in the one query
+        :returns: sample query, None if sql isn't in the expected form
+        """
+        sample_sql, n = re.subn(
+                    r'((?:\[?\w+\]?\.)*)(\[?%s\]?)\s*>\s*\?' % self.seq_field,
+                    r'\1[TIME_STAMP] IN (%s) AND \1\2 > ?' %
+                    ', '.join(['?'] * samples), sql, flags=re.I)
+        return sample_sql if n == 1 else None
+
+    def _load_range(self, start, end, handle):
+        """ Fetch rows with sequence numbers from start to end inclusive a
+            page at a time, within the memory budget, and process them
+
+        :param handle: function taking a page of rows to process
+        :returns: number of rows fetched
+        """
+        range_sql = self._get_range_sql(self.sql)
+        count = 0
+        last = []
+        def process(sqldata):
+            handle(sqldata)
+            last[:] = [sqldata[-1][self.seq_field]]
+        while start <= end:
+            fetch = lambda rows: self.engine.execute(range_sql,
+                                            (rows, start, end)).fetchall()
+            rows, fetched = self._load_page(fetch, process)
+            count += fetched
+            if fetched < rows:
+                break
+            start = last[0] + 1
+        return count
+
+    def reload_range(self, start, end):
+        """ Reload rows with sequence numbers from start to end inclusive
+            through the normal loading path. Docs already in Elasticsearch
+            are overwritten. Sinks aren't sent the rows again.
+
+        :returns: number of rows reloaded
+        """
+        if not self._get_range_sql(self.sql):
+            self.logger.error("Can't find '%s > ?' in SQL, unable to reload" %
+                                self.seq_field)
+            return 0
+        self.initialise()
+        def reload_rows(sqldata):
+            status = self._load_elastic(sqldata, to_sinks=False)
+            if status[1]:
+                self.logger.error("Errors occurred : %s" % status[1])
+        count = self._load_range(start, end, reload_rows)
+        self.logger.info("Reloaded %d rows with sequence numbers %d to %d" %
+                        (count, start, end))
+        return count
+
+    def _fill_gaps(self):
+        """ Load late committed rows that turned up in gaps behind the
+            sequence number, and give up on gaps that have been open too long
+        """
+        if not self.gaps:
+            return
+        for start, end in self.gaps.expire():
+            self.logger.warning("Giving up on sequence numbers %d to %d" %
+                                (start, end))
+        ranges = list(self.gaps)
+        found = []
+        def load_late_rows(sqldata):
+            self._load_rows(sqldata)
+            seqs = [r[self.seq_field] for r in sqldata]
+            self.gaps.fill(seqs)
+            found.extend(seqs)
+        try:
+            # Fetch many gaps per query, a page at a time
+            while ranges:
+                batch = ranges[:GAP_RANGES_PER_QUERY]
+                sql = self._get_range_sql(self.sql, len(batch))
+                params = tuple(n for r in batch for n in r)
+                fetch = lambda rows: self.engine.execute(sql,
+                                                (rows,) + params).fetchall()
+                rows, fetched = self._load_page(fetch, load_late_rows)
+                if fetched < rows:
+                    ranges = ranges[len(batch):]
+                else:
+                    # Carry on after the last row of a full page
+                    last = found[-1]
+                    ranges = [(max(start, last + 1), end)
+                                for start, end in batch if end > last] + \
+                                ranges[len(batch):]
+        except sqlalchemy.exc.DBAPIError, err:
+            self.logger.error("Unable to fetch gaps : %s" % err)
+        if found:
+            self.logger.info("Found %d late rows, %d gaps still open" %
+                            (len(found), len(self.gaps)))
+        self.gaps.save()
+
+    def _runsql(self, rows=None):
         """ Run the SQL query and return the result set 
             
+        :param rows: max rows to fetch, defaults to max_rows
         :returns: SQLAlchemy result from sql query
         """
         self.logger.info("Running SQL where sequence > %s" % self.seq)
         try:
             results = self.engine.execute(self.sql,
-                    (self.max_rows, self.seq)).fetchall()
-        except sqlalchemy.exc.ProgrammingError, err:
+                    (rows or self.max_rows, self.seq)).fetchall()
+        except sqlalchemy.exc.DBAPIError, err:
             self.logger.critical("Error connecting to DB : %s" % err)
             return None
         self.logger.info('Fetched %d rows from DB' % len(results))
@@ -105,6 +464,27 @@ class Loader(object):
             return False
         return results
 
+    def _run_window_sql(self, rows, start, end, timestamp, seq):
+        """ Fetch the rows in a time window after a position
+
+        :param rows: number of rows to fetch
+        :param start: start of the window
+        :param end: end of the window, exclusive
+        :param timestamp: TIME_STAMP of the position
+        :param seq: sequence number of the position
+        :returns: list of rows, None if the query failed
+        """
+        self.logger.info("Running SQL for %s to %s after %s, %s" %
+                        (start, end, timestamp, seq))
+        try:
+            results = self.engine.execute(self.window_sql,
+                    (rows, start, end, timestamp, timestamp, seq)).fetchall()
+        except sqlalchemy.exc.DBAPIError, err:
+            self.logger.critical("Error connecting to DB : %s" % err)
+            return None
+        self.logger.info('Fetched %d rows from DB' % len(results))
+        return results
+
     def _preprocess(self, body):
         """ Use this method to add/modify/aggregate db fields before
             sending this to elasticsearch
@@ -112,31 +492,159 @@ class Loader(object):
         :param body: dict containing sql row result
         :returns: processed dict 
         """
+        return self._enrich(body)
+
+    def _preprocess_batch(self, bodies):
+        """ Use this method to process a whole page of rows at once, e.g.
+            to derive fields column by column
+
+        :param bodies: list of dicts containing sql row results
+        :returns: list of processed dicts
+        """
+        return [self._preprocess(body) for body in bodies]
+
+    def _refresh_dimensions(self):
+        """ Refresh the enrichers' dimensions if due. Called once per
+            page, never per row, by every path that builds docs
+        """
+        for e in self.enrichers:
+            e.refresh_if_due()
+
+    def _enrich(self, body):
+        """ Stamp fields from cached dimension tables onto body
+
+        :param body: doc dict
+        :returns: enriched dict
+        """
+        for e in self.enrichers:
+            e.enrich(body)
         return body
 
-    def _get_index_name(self, timestamp):
+    def _get_index_name(self, timestamp, all_index=None):
         """
         Return an index name based on the rollover settings
         """
+        all_index = all_index or self.es_config['all_index']
         if self.index_rollover.lower() == 'monthly':
-            return "%s-%s" % (self.es_config['all_index'],
-                                timestamp.strftime("%m%Y")) 
+            return "%s-%s" % (all_index, timestamp.strftime("%m%Y")) 
         elif self.index_rollover.lower() == 'daily':
-            return "%s-%s" % (self.es_config['all_index'],
-                                timestamp.strftime("%d%m%Y")) 
+            return "%s-%s" % (all_index, timestamp.strftime("%d%m%Y")) 
         else:
-            return self.es_config['all_index']
+            return all_index
+
+    def _period_start(self, timestamp):
+        """
+        Return the start of the rollover period containing timestamp, or
+        None if the index doesn't roll over
+        """
+        start = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.index_rollover.lower() == 'monthly':
+            return start.replace(day=1)
+        elif self.index_rollover.lower() == 'daily':
+            return start
+        return None
+
+    def _next_period(self, timestamp):
+        """
+        Return the start of the rollover period after the one containing
+        timestamp, or None if the index doesn't roll over
+        """
+        start = self._period_start(timestamp)
+        if start is None:
+            return None
+        if self.index_rollover.lower() == 'monthly':
+            return (start + datetime.timedelta(days=32)).replace(day=1)
+        return start + datetime.timedelta(days=1)
+
+    def _create_index(self, index_name):
+        """ Create an index from the template if it doesn't exist and wait
+            for its shards to be allocated. Once created the index isn't
+            waited on again, even if allocation timed out
 
-    def _load_elastic(self, sqldata):
+        :param index_name: name of index to create
+        :returns: True if the index is ready to take writes
+        """
+        if index_name in self.known_indices:
+            return True
+        try:
+            if not self.es.indices.exists(index=index_name):
+                self.logger.info("Pre-creating index %s" % index_name)
+                # 400 if another loader or a bulk request got there first
+                self.es.indices.create(index=index_name, ignore=400)
+            self.known_indices.add(index_name)
+            health = self.es.cluster.health(index=index_name,
+                                    wait_for_status='yellow',
+                                    timeout=self.precreate_timeout)
+        except elasticsearch.exceptions.TransportError, err:
+            self.logger.warning("Unable to pre-create index %s : %s" %
+                                (index_name, err))
+            return False
+        if health.get('timed_out'):
+            self.logger.warning("Shards for %s not allocated yet" %
+                                index_name)
+            return False
+        return True
+
+    def _precreate_indices(self, now=None):
+        """ Create the current period's indices, and the next period's once
+            we are within precreate_ahead of the rollover, so the first bulk
+            after the rollover doesn't stall on index creation. Rollup
+            indices are created alongside the loader's own
+        """
+        if not self.precreate_ahead:
+            return
+        now = now or self._now()
+        next_period = self._next_period(now)
+        if next_period is None:
+            return
+        periods = [now]
+        if next_period - now <= datetime.timedelta(
+                                    seconds=self.precreate_ahead):
+            periods.append(next_period)
+        all_indices = [self.es_config['all_index']]
+        if self.rollup_config:
+            all_indices.append(self.rollup_config['all_index'])
+        for period in periods:
+            for all_index in all_indices:
+                self._create_index(self._get_index_name(period, all_index))
+
+    def _load_elastic(self, sqldata, to_sinks=True):
         """ iterates through sqldata and bulk loads them into
-            elastic search
+            elastic search, sending a copy of the docs to each sink
 
         :param sqldata: list of sql data rows
+        :param to_sinks: False for rows the sinks have been sent before,
+            e.g. reloads, so the sinks don't get duplicates
         :returns: status of elasticsearch bulk load
         """
+        inserts = self._get_actions(sqldata)
+        if self.sinks and to_sinks and inserts:
+            # Sinks only get the docs, not the rollups which are resent
+            # whenever their sample changes
+            records = get_records(inserts)
+            seq = max(r[self.seq_field] for r in sqldata)
+            for sink in self.sinks:
+                sink.send(records, seq)
+        if self.rollup_config:
+            self.rollup_samples.update(self._get_sample(a['_source'])
+                                        for a in inserts
+                                        if a['_source'].get('CONSUMER_NAME'))
+
+        # Insert list of documents into elasticsearch
+        status = self._bulk(inserts)
+        self.logger.info("Loaded %d docs into elasticsearch" % len(inserts))
+        return status
+
+    def _get_actions(self, sqldata):
+        """ Turn sqldata into bulk actions
+
+        :param sqldata: list of sql data rows
+        :returns: list of bulk actions
+        """
+        self._refresh_dimensions()
         inserts = []
-        for r in sqldata:
-            body = self._preprocess(dict(r.items()))
+        bodies = self._preprocess_batch([dict(r.items()) for r in sqldata])
+        for body in bodies:
             if not body:
                 continue # Skip if preprocessing returns False
             index_name = self._get_index_name(body['TIME_STAMP'])
@@ -147,36 +655,358 @@ class Loader(object):
                 "_source" : body
                 }
             inserts.append(document)
+        return inserts
+
+    def _get_sample(self, row):
+        """ Rollup sample key of a row, its TIME_STAMP and group fields """
+        return (row['TIME_STAMP'],) + tuple(row.get(f)
+                                    for f in self.rollup_config['group_fields'])
+
+    def _load_rollups(self):
+        """ Total the rollup samples touched since the last call and load
+            them into the rollup index. Samples that can't be read from the
+            DB are tried again next time
+        """
+        if not self.rollup_samples:
+            return
+        samples, self.rollup_samples = self.rollup_samples, set()
+        try:
+            actions = self._rollup_actions(samples)
+        except sqlalchemy.exc.DBAPIError, err:
+            self.logger.error("Unable to fetch rollup samples : %s" % err)
+            self.rollup_samples.update(samples)
+            return
+        status = self._bulk(actions)
+        if status[1]:
+            self.logger.error("%d rollup docs not loaded : %s" %
+                                (len(status[1]), status[1]))
+        self.logger.info("Loaded %d rollup docs into elasticsearch" %
+                        (len(actions) - len(status[1])))
+
+    def _rollup_actions(self, samples):
+        """ Total consumer values for each level of the consumer hierarchy
+            in each sample
+
+            A sample's rows can be split across pages, commit late or be
+            reloaded, so each sample is totalled again from all of its rows
+            in the DB rather than from the docs at hand. Rollup ids are
+            deterministic, so the new totals replace the old.
+
+        :param samples: set of sample keys
+        :returns: list of bulk actions for the rollup index
+        """
+        group_fields = self.rollup_config['group_fields']
+        tree = ConsumerTree(self.rollup_config['fields'])
+        last = [] # sequence number of the last row read
+        def add_rows(sqldata):
+            for r in sqldata:
+                r = dict(r.items())
+                sample = self._get_sample(r)
+                if sample in samples and r.get('CONSUMER_NAME'):
+                    tree.add(sample, r['CONSUMER_NAME'], r)
+            last[0] = sqldata[-1][self.seq_field]
+
+        timestamps = sorted(set(s[0] for s in samples))
+        for i in range(0, len(timestamps), SAMPLES_PER_QUERY):
+            batch = tuple(timestamps[i:i + SAMPLES_PER_QUERY])
+            sql = self._get_sample_sql(self.sql, len(batch))
+            last[:] = [-1]
+            while True:
+                fetch = lambda rows: self.engine.execute(sql,
+                                        (rows,) + batch + (last[0],)).fetchall()
+                rows, fetched = self._load_page(fetch, add_rows)
+                if fetched < rows:
+                    break
+
+        actions = []
+        for sample in tree.samples:
+            timestamp = sample[0]
+            for path, depth, leaves, totals in tree.totals(sample):
+                doc = dict(zip(group_fields, sample[1:]))
+                doc.update(totals)
+                doc.update({
+                    'TIME_STAMP': timestamp,
+                    'CONSUMER_PATH': path,
+                    'CONSUMER_PARENT': (path.rsplit('/', 1)[0] or '/')
+                                        if depth else None,
+                    'CONSUMER_DEPTH': depth,
+                    'NUM_CONSUMERS': leaves,
+                })
+                key = u'|'.join([timestamp.isoformat()] +
+                                [unicode(v) for v in sample[1:]] + [path])
+                actions.append({
+                    "_index" : self._get_index_name(timestamp,
+                                        self.rollup_config['all_index']),
+                    "_type" : 'default',
+                    "_id" : hashlib.sha1(key.encode('utf-8')).hexdigest(),
+                    "_source" : doc
+                })
+        return actions
+
+    def _send_chunk(self, chunk):
+        """ Send a single bulk request to elasticsearch
+
+        :param chunk: list of bulk actions
+        :returns: list of (action, item) tuples for failed actions
+        """
+        if self.governor:
+            self.governor.acquire(self.name, self.bulk_weight)
+        start = time.time()
+        failed = []
+        # Match failures to actions by id rather than by position, in case
+        # the chunk is ever split or reordered
+        actions = dict((unicode(a['_id']), a) for a in chunk)
+        try:
+            # Count the bytes sent against this loader
+            with transport_stats.tagged(self.name):
+                for ok, item in helpers.streaming_bulk(self.es, chunk,
+                                            chunk_size=len(chunk),
+                                            max_chunk_bytes=BULK_MAX_BYTES,
+                                            raise_on_error=False,
+                                            raise_on_exception=False):
+                    if not ok:
+                        failed.append((actions[unicode(
+                                        item.values()[0]['_id'])], item))
+        finally:
+            if self.governor:
+                rejected = any(item.values()[0].get('status') in
+                                RETRY_STATUSES for _, item in failed)
+                self.governor.release(time.time() - start, rejected)
+        return failed
+
+    def _bulk(self, inserts):
+        """ Bulk load actions into elasticsearch, resending only the items
+            that were rejected because the cluster was busy
+
+        :param inserts: list of bulk actions
+        :returns: tuple of number of successful actions and list of errors
+            for actions that could not be loaded
+        """
+        pending = inserts
+        errors = []
+        for attempt in range(self.bulk_max_retries + 1):
+            failed = []
+            for i in range(0, len(pending), self.chunk_size):
+                failed.extend(self._send_chunk(pending[i:i + self.chunk_size]))
 
+            retry = []
+            for action, item in failed:
+                status = item.values()[0].get('status')
+                if status in RETRY_STATUSES and \
+                        attempt < self.bulk_max_retries:
+                    retry.append(action)
+                else:
+                    errors.append((action, item))
+            if not retry:
+                break
+
+            wait = self.bulk_retry_wait * 2 ** attempt
+            self.logger.warning("%d items rejected, retrying in %s seconds" %
+                                (len(retry), wait))
+            time.sleep(wait)
+            pending = retry
+
+        if errors:
+            self._dead_letter(errors)
+        return (len(inserts) - len(errors), [item for _, item in errors])
+
+    def _dead_letter(self, errors):
+        """ Write actions that could not be loaded to the day's dead letter
+            file so they can be inspected and replayed later. Old files
+            can be removed once dealt with
+
+        :param errors: list of (action, item) tuples
+        """
+        if not self.dead_letter_dir:
+            return
+        if not os.path.isdir(self.dead_letter_dir):
+            os.makedirs(self.dead_letter_dir)
+        path = os.path.join(self.dead_letter_dir, "%s-%s.jsonl" %
+                    (self.es_config['template_name'],
+                    datetime.datetime.utcnow().strftime('%Y%m%d')))
+        serializer = self.es.transport.serializer
+        with open(path, 'a') as f:
+            for action, item in errors:
+                # Exceptions in the item can't be serialised
+                error = dict((k, v) for k, v in item.values()[0].iteritems()
+                                if k not in ('exception', 'data'))
+                f.write(serializer.dumps({"action": action, "error": error}))
+                f.write('\n')
+        self.logger.error("Wrote %d failed items to %s" % (len(errors), path))
+
+    def _reserve_rows(self):
+        """ Reserve memory for the next page from the memory budget
+
+        :returns: tuple of number of rows to fetch and bytes reserved
+        """
+        if not self.memory_budget:
+            return (self.max_rows, 0)
+        row_bytes = self.row_bytes * ROW_COPIES
+        reserved = self.memory_budget.reserve(self.max_rows * row_bytes,
+                                            self.min_rows * row_bytes)
+        rows = max(1, min(self.max_rows, reserved // row_bytes))
+        self.logger.info("Reserved %d rows, memory budget %.1f%% used" %
+                    (rows, 100 * self.memory_budget.utilisation()))
+        return (rows, reserved)
+
+    def _measure_rows(self, sqldata, sample=50):
+        """ Update the average row size estimate from a fetched page
+
+        :param sqldata: list of sql data rows
+        :param sample: number of rows to measure
+        """
+        step = max(1, len(sqldata) // sample)
+        rows = sqldata[::step]
+        size = sum(sys.getsizeof(r) + sum(sys.getsizeof(k) + sys.getsizeof(v)
+                    for k, v in r.items()) for r in rows) // len(rows)
+        # Smooth so one odd page doesn't swing the page size
+        self.row_bytes = (self.row_bytes + size) // 2
+
+    def _load_page(self, fetch, handle):
+        """ Fetch a page of rows within the memory budget and process it,
+            then total the rollup samples it touched
+
+        :param fetch: function taking the number of rows to fetch and
+            returning the rows, None if the query failed
+        :param handle: function taking a page of rows to process
+        :returns: tuple of number of rows asked for and fetched, None if
+            the query failed
+        """
+        rows, reserved = self._reserve_rows()
+        try:
+            sqldata = fetch(rows)
+            if sqldata is None:
+                return None
+            fetched = len(sqldata or [])
+            if sqldata:
+                self._measure_rows(sqldata)
+                handle(sqldata)
+            # Drop the page before giving its memory back
+            sqldata = None
+        finally:
+            if reserved:
+                self.memory_budget.release(reserved)
+        # Rollups read pages of their own, so not while holding this one
+        self._load_rollups()
+        return (rows, fetched)
+
+    def _load_rows(self, sqldata):
+        """ Load a page of rows. Items that still fail after retries have
+            been dead lettered, so we carry on rather than stall the loader
+            on docs Elasticsearch won't take
+        """
+        status = self._load_elastic(sqldata)
+        if status[1]:
+            self.logger.error("%d docs not loaded : %s" %
+                                (len(status[1]), status[1]))
+
+    def _load_new_rows(self, sqldata):
+        """ Load a page of rows after the sequence number and move the
+            sequence number on
+        """
+        self._load_rows(sqldata)
+        if self.gaps is not None:
+            seqs = [r[self.seq_field] for r in sqldata]
+            # Nothing before the first load, but gaps within it count
+            last_seq = self.seq if self.seq >= 0 else seqs[0] - 1
+            if self.gaps.observe(last_seq, seqs):
+                self.gaps.save()
         # update sequence to last item in the results
         self.seq = sqldata[-1][self.seq_field]
-        
-        # Insert list of documents into elasticsearch
-        status = helpers.bulk(self.es, inserts, self.chunk_size)
-        self.logger.info("Inserted %d chunks into %s" % (self.chunk_size,
-                                                        index_name))
-        return status
+
+    def _log_transport_stats(self):
+        requests, raw, compressed = transport_stats.get(self.name)
+        if requests:
+            self.logger.info("Sent %d bulk requests, %.1f MB, %.1f MB "
+                            "on the wire" % (requests, raw / 1048576.0,
+                                            compressed / 1048576.0))
+
+    def _load_window_rows(self, sqldata):
+        """ Load the rows of a window page that haven't been loaded yet
+            and move the position on
+
+        :param sqldata: list of sql data rows
+        """
+        keys = [(r['TIME_STAMP'], r[self.seq_field]) for r in sqldata]
+        # The overlap is read every load, only send what's new
+        unseen = [r for r, k in zip(sqldata, keys)
+                    if k not in self.position.recent]
+        if unseen:
+            self._load_rows(unseen)
+        self.seq = max([self.seq] + [k[1] for k in keys])
+        self.position.remember(keys)
+        self.position.advance(*keys[-1])
+        self.position.forget(self.position.position[0] -
+                            datetime.timedelta(seconds=self.window_overlap))
+
+    def _load_windows(self, now=None):
+        """ Loads DB rows into Elasticsearch a time window at a time, so
+            each query reads one partition of a table partitioned on
+            TIME_STAMP and each bulk writes to one index
+
+            Reading starts window_overlap seconds before the checkpoint so
+            rows that committed late are picked up. Rows committed later
+            than that are missed. Rows in the overlap that were already
+            loaded aren't loaded again, the ones loaded are kept with the
+            position so this holds across restarts.
+
+        :returns: status of elasticsearch bulk load
+        """
+        now = now or self._now()
+        timestamp, seq = self.position.position
+        if self.window_overlap:
+            timestamp -= datetime.timedelta(seconds=self.window_overlap)
+            seq = -1
+        while True:
+            start, end = self._window(timestamp)
+            fetch = lambda rows: self._run_window_sql(rows, start, end,
+                                                    timestamp, seq)
+            last = []
+            def handle(sqldata):
+                self._load_window_rows(sqldata)
+                last.append((sqldata[-1]['TIME_STAMP'],
+                            sqldata[-1][self.seq_field]))
+            page = self._load_page(fetch, handle)
+            if page is None:
+                return True
+            rows, fetched = page
+            if last:
+                timestamp, seq = last[0]
+
+            if fetched < rows:
+                if end > now:
+                    self.position.save()
+                    self.logger.info("Finished inserting up to %s, %d" %
+                                    self.position.position)
+                    self._log_transport_stats()
+                    return True
+                # Window is over, move on to the next one
+                timestamp, seq = end, -1
+                self.position.advance(timestamp, seq)
+            self.position.save()
 
     def load(self):
         """ Loads all DB rows into Elasticsearch
             
         :returns: status of elasticsearch bulk load
         """
+        self.initialise()
+        self._catch_up_sinks()
+        self._precreate_indices()
+        if self.cursor == 'time_window':
+            return self._load_windows()
+        self._fill_gaps()
         while True:
-            sqldata = self._runsql()
-            if not sqldata: # No rows to process. Return for now
+            page = self._load_page(self._runsql, self._load_new_rows)
+            if page is None: # DB error. Return for now
                 return True
-
-            status = self._load_elastic(sqldata)
-            if status[1]:
-                self.logger.error("Errors occurred : %s" % status[1])
-                # TODO: Should we quit(return False) here 
-                # since there are errors ?
+            rows, fetched = page
 
             # This should be the remainder and nothing left after that
             # since we didn't exceed max rows
-            if len(sqldata) < self.max_rows:
+            if fetched < rows:
                 self.logger.info("Finished inserting up to %d" % self.seq)
+                self._log_transport_stats()
                 return True
 
     def __str__(self):
@@ -205,11 +1035,61 @@ class SessionHistoryLoader(Loader):
 
     This is for the non-sampled SESSION_HISTORY table which contains
     details on ALL sessions.
+
+    We derive per session metrics at ingest time so dashboards can
+    aggregate on stored fields rather than scripted fields:
+
+    SESSION_DURATION - seconds between CREATE_TIME and END_TIME
+    AVG_TASK_RUNTIME - TOTAL_TASKS_RUNTIME per completed task
+    AVG_SUBMIT2START_TIME - TOTAL_TASKS_SUBMIT2START_TIME per completed or
+        failed task
+    TASK_FAILURE_RATIO - fraction of task runs that were unsuccessful
+
+    Fields are left out when they can't be computed, e.g. for sessions
+    that haven't ended or have no finished tasks.
     
     """
     def __init__(self, *args, **kwargs):
         super(SessionHistoryLoader, self).__init__(*args, **kwargs)
 
+    @staticmethod
+    def _ratio(numerators, denominators):
+        return [float(n) / d if n is not None and d else None
+                    for n, d in zip(numerators, denominators)]
+
+    def _preprocess_batch(self, bodies):
+        bodies = [b for b in
+                    super(SessionHistoryLoader, self)._preprocess_batch(bodies)
+                    if b]
+
+        # Work column by column over the page rather than row by row
+        def column(field):
+            return [b.get(field) for b in bodies]
+        done = [n or 0 for n in column('NUM_TASK_DONE')]
+        errors = [n or 0 for n in column('NUM_TASK_ERROR')]
+        unsuccessful = [n or 0 for n in column('TOTAL_UNSUCCESS_TASKRUNS')]
+
+        derived = {
+            'SESSION_DURATION': [
+                    (end - start).total_seconds()
+                    if start is not None and end is not None and end >= start
+                    else None
+                    for start, end in zip(column('CREATE_TIME'),
+                                            column('END_TIME'))],
+            'AVG_TASK_RUNTIME': self._ratio(column('TOTAL_TASKS_RUNTIME'),
+                                            done),
+            'AVG_SUBMIT2START_TIME': self._ratio(
+                    column('TOTAL_TASKS_SUBMIT2START_TIME'),
+                    [d + e for d, e in zip(done, errors)]),
+            'TASK_FAILURE_RATIO': self._ratio(unsuccessful,
+                    [d + u for d, u in zip(done, unsuccessful)]),
+        }
+        for field, values in derived.iteritems():
+            for body, value in zip(bodies, values):
+                if value is not None:
+                    body[field] = value
+        return bodies
+
 
 class ResourceMetricsLoader(Loader):
     """ Loader for RESOURCE_METRICS Table 
@@ -217,6 +1097,11 @@ class ResourceMetricsLoader(Loader):
     We do some preprocessing here to only take attributes that are defined in
     the attr_fields list - others will be discarded.
 
+    Docs are keyed by a hash of the resource and timestamp. Docs loaded
+    by earlier versions were keyed by INSERT_SEQ, so reloading or
+    reconciling days loaded before the change duplicates them. Delete
+    those days' indices, or the docs in them, before reloading them.
+
     """
     attr_fields = { 
             "ncpus" : "NUM_CPUS",
@@ -239,9 +1124,18 @@ class ResourceMetricsLoader(Loader):
             "it" : "IDLE_TIME",
     }
 
+    # Rows are pivoted into one doc per resource-timestamp
+    reconcile_counts = False
+
     def __init__(self, *args, **kwargs):
         super(ResourceMetricsLoader, self).__init__(*args, **kwargs)
 
+    @staticmethod
+    def _get_doc_id(resource, timestamp):
+        # Deterministic id so reloading a range updates rather than duplicates
+        return hashlib.sha1("%s|%s" % (resource, timestamp.isoformat())) \
+                .hexdigest()
+
     def _get_attr_val(self, sqlrow):
         # only convert the metrics field and leave the rest as it is
         attr = ResourceMetricsLoader.attr_fields.get(sqlrow['ATTRIBUTE_NAME'],
@@ -255,9 +1149,8 @@ class ResourceMetricsLoader(Loader):
             val = sqlrow['ATTRIBUTE_VALUE_NUM']
         return (attr, val)
 
-    def _load_elastic(self, sqldata):
-        """ iterates through sqldata and bulk loads them into
-            elastic search
+    def _get_actions(self, sqldata):
+        """ Turn sqldata into bulk actions
 
             Since each sql row contains only a single attribute-value pair
             we will need to finish processing all the records before inserting
@@ -265,8 +1158,9 @@ class ResourceMetricsLoader(Loader):
             resource-timestamp
 
         :param sqldata: list of sql data rows
-        :returns: status of elasticsearch bulk load
+        :returns: list of bulk actions
         """
+        self._refresh_dimensions()
         from collections import defaultdict
         attributes = ResourceMetricsLoader.attr_fields.keys()
         records = defaultdict(lambda: defaultdict(int))
@@ -286,25 +1180,19 @@ class ResourceMetricsLoader(Loader):
         for k, v in records.iteritems():
             body = { attr: val for attr, val in v.iteritems() } 
             body['RESOURCE_NAME'], body['TIME_STAMP'] = k
+            self._enrich(body)
+            # Attributes for a resource-timestamp can be split across
+            # batches, so merge into the existing doc instead of replacing it
             document = {
+                "_op_type" : 'update',
                 "_index" : self._get_index_name(body['TIME_STAMP']),
                 "_type" : 'default',
-                "_source" : body
+                "_id" : self._get_doc_id(*k),
+                "doc" : body,
+                "doc_as_upsert" : True
             }
             inserts.append(document)
-        
-        # Insert list of documents into elasticsearch
-        self.logger.info("Loading chunk into elasticsearch")
-        status = helpers.bulk(self.es,
-                                inserts,
-                                self.chunk_size)
-        self.logger.info("Finished loading chunk into elasticsearch")
-
-        # update sequence to last item in the results
-        #self.seq = dict(results[-1].items())[self.id_field]
-        self.seq = sqldata[-1][self.seq_field]
-        
-        return status
+        return inserts
 
 
 class ConsumerResourceAllocationLoader(Loader):
@@ -0,0 +1,196 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import logging
+import os
+import sys
+import threading
+import time
+import cProfile
+import pstats
+import StringIO
+from collections import defaultdict
+
+module_name = 'Ensemble.profiler'
+module_logger = logging.getLogger(module_name)
+
+class CProfileSession(object):
+    """ Deterministic profile of a loader using cProfile
+
+    Every function call is traced, so numbers are exact but the loader
+    runs noticeably slower while being profiled.
+
+    """
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        """ Write pstats file
+
+        :param path: output path without extension
+        :returns: list of files written
+        """
+        self.profile.dump_stats(path + '.pstats')
+        return [path + '.pstats']
+
+    def summary(self, top):
+        out = StringIO.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(top)
+        return out.getvalue()
+
+class SamplingSession(object):
+    """ Low overhead profile of a loader by sampling its thread's stack
+
+    A background thread records the loader thread's stack every interval
+    seconds. Output is in collapsed-stack format for flamegraph.pl.
+
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        self.thread_id = threading.current_thread().ident
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self._sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name,
+                            os.path.basename(code.co_filename),
+                            code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.stacks[';'.join(stack)] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path):
+        """ Write collapsed stacks file
+
+        :param path: output path without extension
+        :returns: list of files written
+        """
+        with open(path + '.collapsed', 'w') as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write("%s %d\n" % (stack, count))
+        return [path + '.collapsed']
+
+    def summary(self, top):
+        cumulative = defaultdict(int)
+        for stack, count in self.stacks.iteritems():
+            for func in set(stack.split(';')):
+                cumulative[func] += count
+        lines = ["%d samples, top functions by cumulative samples:" %
+                    self.samples]
+        for func, count in sorted(cumulative.iteritems(),
+                            key=lambda x: x[1], reverse=True)[:top]:
+            lines.append("%6.1f%%  %s" %
+                    (100.0 * count / max(1, self.samples), func))
+        return '\n'.join(lines)
+
+class LoaderProfiler(object):
+    """ Profiles a number of load() iterations of chosen loaders
+
+    Profiling is requested by loader name, then the loader's worker thread
+    runs its next iterations through run() instead of calling load()
+    directly. Results are written per loader once all iterations are done.
+
+    """
+    modes = {
+        'cprofile': CProfileSession,
+        'sampling': SamplingSession,
+    }
+
+    def __init__(self, mode='cprofile', iterations=5, output_dir='profiles',
+                    top=20):
+        """
+        :param mode: 'cprofile' for deterministic or 'sampling'
+        :param iterations: number of load() calls to profile
+        :param output_dir: directory to write profile files to
+        :param top: number of functions to show in the summary
+        """
+        if mode not in LoaderProfiler.modes:
+            raise ValueError("Unknown profile mode %s" % mode)
+        self.mode = mode
+        self.iterations = iterations
+        self.output_dir = output_dir
+        self.top = top
+        self.lock = threading.Lock()
+        self.pending = {} # loader name -> iterations left
+        self.sessions = {}
+
+    def request(self, names, known=None):
+        """ Profile the next iterations of the named loaders
+
+        :param names: list of loader names
+        :param known: names of the loaders that are running. Names that
+            aren't in it are skipped with a warning
+        """
+        with self.lock:
+            for name in names:
+                if known is not None and name not in known:
+                    module_logger.warning("No loader called %s to profile" %
+                                            name)
+                    continue
+                module_logger.info("Profiling %d iterations of %s" %
+                                    (self.iterations, name))
+                self.pending[name] = self.iterations
+
+    def wants(self, loader):
+        """ True if the loader's next iteration should be profiled """
+        return self.pending.get(loader.name, 0) > 0
+
+    def run(self, loader):
+        """ Run one profiled iteration of loader.load()
+
+        :param loader: loader object
+        :returns: result of loader.load()
+        """
+        session = self.sessions.get(loader.name)
+        if session is None:
+            session = self.sessions[loader.name] = self.modes[self.mode]()
+        session.start()
+        try:
+            return loader.load()
+        finally:
+            session.stop()
+            with self.lock:
+                self.pending[loader.name] -= 1
+                done = not self.pending[loader.name]
+            if done:
+                del self.sessions[loader.name]
+                self._report(loader, session)
+
+    def _report(self, loader, session):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        path = os.path.join(self.output_dir, "%s-%s" %
+                        (loader.name, time.strftime("%Y%m%d%H%M%S")))
+        files = session.write(path)
+        loader.logger.info("Profile of %d iterations written to %s\n%s" %
+                    (self.iterations, ', '.join(files),
+                    session.summary(self.top)))
@@ -0,0 +1,180 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import datetime
+import logging
+import re
+import threading
+
+module_name = 'Ensemble.reconcile'
+module_logger = logging.getLogger(module_name)
+
+DAY_SQL = """
+    SELECT CAST([TIME_STAMP] AS DATE) AS DAY, COUNT(*) AS NUM_ROWS,
+    MIN([%(seq)s]) AS MIN_SEQ, MAX([%(seq)s]) AS MAX_SEQ
+    FROM %(table)s
+    WHERE [TIME_STAMP] >= ? AND [TIME_STAMP] < ?
+    GROUP BY CAST([TIME_STAMP] AS DATE)
+"""
+
+def get_table(sql):
+    """ Table a loader's SQL selects from
+
+    :returns: table name, None if it can't be found
+    """
+    match = re.search(r'\bFROM\s+([\[\]\w.]+)', sql, re.I)
+    return match.group(1) if match else None
+
+def db_days(loader, since, until, table=None):
+    """ Rows per day in the loader's table
+
+    :param loader: loader object
+    :param since: first day to count
+    :param until: day after the last day to count
+    :param table: table to count, defaults to the one in the loader's SQL
+    :returns: dict of day -> (count, min seq, max seq)
+    """
+    table = table or get_table(loader.sql)
+    rows = loader.engine.execute(DAY_SQL % {'seq': loader.seq_field,
+                                            'table': table},
+                                (since, until)).fetchall()
+    days = {}
+    for r in rows:
+        day = r['DAY']
+        # Some drivers return dates as strings
+        if not isinstance(day, datetime.date):
+            day = datetime.datetime.strptime(str(day), '%Y-%m-%d').date()
+        days[day] = (r['NUM_ROWS'], r['MIN_SEQ'], r['MAX_SEQ'])
+    return days
+
+def es_days(loader, since, until):
+    """ Docs per day in the loader's indices
+
+    :param loader: loader object
+    :param since: first day to count
+    :param until: day after the last day to count
+    :returns: dict of day -> (count, min seq, max seq)
+    """
+    body = {
+        "size": 0,
+        "query": {"range": {"TIME_STAMP": {"gte": since.isoformat(),
+                                            "lt": until.isoformat()}}},
+        "aggs": {
+            "days": {
+                "date_histogram": {
+                    "field": "TIME_STAMP",
+                    "interval": "day",
+                    "min_doc_count": 1,
+                },
+                "aggs": {
+                    "min_seq": {"min": {"field": loader.seq_field}},
+                    "max_seq": {"max": {"field": loader.seq_field}},
+                }
+            }
+        }
+    }
+    res = loader.es.search(index=loader.es_config['all_index'], body=body,
+                            ignore_unavailable=True)
+    days = {}
+    for b in res['aggregations']['days']['buckets']:
+        day = datetime.datetime.utcfromtimestamp(b['key'] / 1000).date()
+        days[day] = (b['doc_count'], int(b['min_seq']['value']),
+                        int(b['max_seq']['value']))
+    return days
+
+def compare(loader, db, es):
+    """ Days that don't match between DB and Elasticsearch
+
+    :returns: tuple of list of (day, db, es) mismatches for days that are
+        in the DB, and list of days only in Elasticsearch, e.g. because
+        they have been purged from the DB
+    """
+    mismatched = []
+    for day in sorted(db):
+        if day not in es:
+            mismatched.append((day, db[day], None))
+        elif loader.reconcile_counts and db[day] != es[day]:
+            mismatched.append((day, db[day], es[day]))
+    return mismatched, sorted(set(es) - set(db))
+
+class Reconciler(object):
+    """ Compares each day's rows in the DB with the docs in Elasticsearch
+        for a set of loaders, and optionally reloads the days that don't
+        match through the normal loader path.
+
+    """
+    def __init__(self, loaders, days=7, reload=False, tables=None,
+                    today=None):
+        """
+        :param loaders: list of loader objects
+        :param days: number of days back to check. Today is still being
+            loaded, so it isn't checked
+        :param reload: reload sequence number ranges of mismatched days
+        :param tables: dict of loader name -> table, for loaders whose
+            table can't be found from their SQL
+        :param today: date to reconcile up to, not including it. Defaults
+            to today
+        """
+        self.loaders = loaders
+        self.days = days
+        self.reload = reload
+        self.tables = tables or {}
+        self.today = today
+        self.results = {}
+
+    def _reconcile(self, loader, since, until):
+        table = self.tables.get(loader.name) or get_table(loader.sql)
+        if not table:
+            loader.logger.error("Can't find table in SQL, not reconciling")
+            return
+        results = {}
+        # Count in the DB while Elasticsearch aggregates
+        def count_db():
+            try:
+                results['db'] = db_days(loader, since, until, table)
+            except Exception:
+                loader.logger.exception("Unable to count rows in DB")
+        t = threading.Thread(target=count_db)
+        t.start()
+        try:
+            es = es_days(loader, since, until)
+        except Exception:
+            loader.logger.exception("Unable to count docs in Elasticsearch")
+            return
+        finally:
+            t.join()
+        if 'db' not in results:
+            return
+
+        mismatched, es_only = compare(loader, results['db'], es)
+        self.results[loader.name] = (mismatched, es_only)
+        for day, db_day, es_day in mismatched:
+            loader.logger.warning("%s mismatch DB (rows, min, max seq) = %s "
+                                "ES = %s" % (day, db_day, es_day))
+        if es_only:
+            loader.logger.info("Days only in Elasticsearch : %s" %
+                            ', '.join(str(d) for d in es_only))
+        if not mismatched:
+            loader.logger.info("All %d days match" % len(results['db']))
+        elif self.reload:
+            for day, (_, min_seq, max_seq), _ in mismatched:
+                loader.logger.info("Reloading %s" % day)
+                loader.reload_range(min_seq, max_seq)
+
+    def run(self):
+        """ Reconcile all loaders in parallel
+
+        :returns: dict of loader name -> (mismatched days, ES only days)
+        """
+        until = self.today or datetime.date.today()
+        since = until - datetime.timedelta(days=self.days)
+        threads = []
+        for loader in self.loaders:
+            t = threading.Thread(target=self._reconcile,
+                                args=(loader, since, until))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return self.results
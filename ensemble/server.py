@@ -9,6 +9,7 @@ import yaml
 import os
 import signal
 import threading
+import argparse
 
 from loader import (
         BasicSQLLoader,
@@ -19,6 +20,12 @@ from loader import (
         SessionAttributesLoader
 )
 from helpers import get_db_engine, get_es_conn
+from budget import MemoryBudget
+from profiler import LoaderProfiler
+from enrichment import DimensionCache, Enricher
+from governor import BackpressureGovernor, DEFAULT_MAX_LIMIT
+from reconcile import Reconciler
+from sinks import get_sink
 import index_config.consumer_demand
 import index_config.resource_metrics
 import index_config.consumer_resource_allocation
@@ -27,42 +34,95 @@ import index_config.session_history
 
 CONFIG_FILE="config.yml" # always look for config.yml in CWD
 cleanup_funcs = [] # List of cleanup functions to run before exiting
-threads = [] # loader threads
-kill_threads = False
+workers = {} # loader name -> LoaderWorker
+profiler = None # LoaderProfiler, set up in main
+profile_names = [] # loaders to profile when SIGUSR1 is received
+reload_requested = threading.Event() # set by SIGHUP or config file change
+dimensions = {} # dimension name -> DimensionCache shared by loaders
+governor = None # BackpressureGovernor shared by loaders
 
 def cleanup(*args):
     print("Cleaning up on exit")
+    for w in workers.values():
+        w.stop()
+    # Workers close their loaders once their current load is done
+    for w in workers.values():
+        while w.is_alive():
+            w.join(1)
     for f in cleanup_funcs:
         f()
     print("Finished cleaning up, exiting")
     sys.exit(0)
 
-def worker(loader, interval):
+class LoaderWorker(threading.Thread):
     """ Continuously load data in between intervals """
-    while not kill_threads:
-        loader.load()
-        time.sleep(interval)
-
-def cleanup_threads():
-    kill_threads = True
-    print("Kill signal sent to threads")
-    while threads:
-        print("Number of threads alive : %d" % len(threads))
-        print("Waiting 5 seconds for threads to finish")
-        time.sleep(5)
-
-def run(loaders, interval):
+    def __init__(self, loader, interval):
+        super(LoaderWorker, self).__init__(name=loader.name)
+        self.daemon = True
+        self.loader = loader
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if profiler and profiler.wants(self.loader):
+                    profiler.run(self.loader)
+                else:
+                    self.loader.load()
+            except Exception:
+                self.loader.logger.exception("Error loading, will retry")
+            self.stopped.wait(self.interval)
+        self.loader.close()
+
+    def stop(self):
+        """ Stop once the current iteration is finished """
+        self.stopped.set()
+
+def toggle_profiling(*args):
+    """ Profile the next iterations of the loaders given with --profile,
+        or of every loader if none were given
+    """
+    names = profile_names or workers.keys()
+    profiler.request(names, workers.keys())
+
+def request_reload(*args):
+    reload_requested.set()
+
+def get_interval(cfg, loadername):
+    """ Loaders can override the interval in setup """
+    return cfg['loaders'][loadername].get('interval',
+                                        cfg['setup']['interval'])
+
+def run(loaders, cfg):
     """ Create a thread for each loader and start running
 
     :param loaders: list of loader objects 
-    :param interval: duration in seconds between each loading iteration
+    :param cfg: config dict to get intervals between loading iterations
     """ 
-    for i in range(len(loaders)):
-        t = threading.Thread(target=worker, args=(loaders[i], interval))
-        threads.append(t)
+    for loader in loaders:
+        w = LoaderWorker(loader, get_interval(cfg, loader.name))
+        workers[loader.name] = w
+        w.start()
+
+def initialise(loaders, logger):
+    """ Initialise loaders in parallel in the background. Loaders that
+        aren't ready when they first load will wait for it to finish
+
+    :param loaders: list of loader objects
+    """
+    def init(loader):
+        try:
+            loader.initialise()
+        except Exception:
+            logger.exception("Failed initialising %s, will retry on "
+                            "first load" % loader)
+    for loader in loaders:
+        t = threading.Thread(target=init, args=(loader,))
+        t.daemon = True
         t.start()
 
-def get_loaders(cfg, engine, es, logger):
+def get_loader(loadername, cfg, engine, es, logger, budget=None):
     classmap = {
             "resource_metrics": ResourceMetricsLoader,
             "consumer_demand": ConsumerDemandLoader,
@@ -70,27 +130,200 @@ def get_loaders(cfg, engine, es, logger):
             "session_attributes": SessionAttributesLoader,
             "session_history": SessionHistoryLoader
     }
-    loaders = []
-    for loadername, loaderconf in cfg['loaders'].iteritems():
-        config = getattr(index_config, loadername).config
-        loaderclass = classmap.get(loadername, BasicSQLLoader)
-        if loaderclass.__name__ == 'BasicSQLLoader':
-            logger.warning("Couldn't find loader for %s, falling back to BasicSQLLoader" % loadername)
-        else:
-            logger.info("Created loader : %s" % loaderclass.__name__)
-        loaders.append(loaderclass(db_engine=engine,
-                            es_conn=es,
-                            sql=loaderconf['sql'],
-                            max_rows=cfg['setup']['max_rows'],
-                            es_config=config))
+    setup = cfg['setup']
+    loaderconf = cfg['loaders'][loadername]
+    config = getattr(index_config, loadername).config
+    loaderclass = classmap.get(loadername, BasicSQLLoader)
+    if loaderclass.__name__ == 'BasicSQLLoader':
+        logger.warning("Couldn't find loader for %s, falling back to BasicSQLLoader" % loadername)
+    else:
+        logger.info("Created loader : %s" % loaderclass.__name__)
+    enrichers = [Enricher(dimensions[e['dimension']], e['key'],
+                            e.get('prefix', ''))
+                    for e in loaderconf.get('enrich', [])]
+    sinks = [get_sink(loadername, s, setup.get('state_dir'))
+                for s in loaderconf.get('sinks', [])]
+    return loaderclass(db_engine=engine,
+                        es_conn=es,
+                        sql=loaderconf['sql'],
+                        max_rows=setup['max_rows'],
+                        es_config=config,
+                        bulk_max_retries=setup.get('bulk_max_retries', 3),
+                        bulk_retry_wait=setup.get('bulk_retry_wait', 1),
+                        dead_letter_dir=setup.get('dead_letter_dir'),
+                        precreate_ahead=setup.get('precreate_ahead', 3600),
+                        memory_budget=budget,
+                        enrichers=enrichers,
+                        rollup=loaderconf.get('rollup', False),
+                        governor=governor,
+                        bulk_weight=loaderconf.get('weight', 1),
+                        state_dir=setup.get('state_dir'),
+                        gap_max_age=setup.get('gap_max_age', 3600)
+                                    if loaderconf.get('track_gaps') else 0,
+                        sinks=sinks,
+                        cursor=loaderconf.get('cursor', 'seq'),
+                        window_sql=loaderconf.get('window_sql', ''),
+                        window_overlap=loaderconf.get('window_overlap', 300),
+                        window_start=loaderconf.get('window_start'),
+                        utc_timestamps=setup.get('utc_timestamps', False))
+
+def get_dimensions(cfg, engine):
+    """ Build the dimension caches that loaders enrich docs from """
+    return dict((name, DimensionCache(name, engine, dimconf['sql'],
+                                    dimconf['key'],
+                                    refresh=dimconf.get('refresh', 300),
+                                    ttl=dimconf.get('ttl', 86400)))
+                for name, dimconf in cfg.get('dimensions', {}).iteritems())
+
+def get_loaders(cfg, engine, es, logger, budget=None):
+    loaders = [get_loader(loadername, cfg, engine, es, logger, budget)
+                for loadername in cfg['loaders']]
+    initialise(loaders, logger)
     return loaders
 
+def reload_config(path, cfg, engine, es, logger, budget=None):
+    """ Add, remove or reconfigure loaders that changed in the config file
+        without restarting the others. Changes to setup other than the
+        interval, and to dimensions, need a restart.
+
+    :param path: path to config file
+    :param cfg: config dict currently in use
+    :returns: config dict now in use
+    """
+    logger.info("Reloading %s" % path)
+    try:
+        with open(path, 'r') as ymlfile:
+            new_cfg = yaml.safe_load(ymlfile)
+        new_cfg['setup']['interval'], new_cfg['loaders'].keys()
+    except (IOError, yaml.YAMLError, KeyError, TypeError,
+            AttributeError), err:
+        logger.error("Not reloading, invalid config : %s" % err)
+        return cfg
+
+    setup = dict(cfg['setup'], interval=new_cfg['setup']['interval'])
+    if setup != new_cfg['setup']:
+        logger.warning("Only interval can be changed in setup without a "
+                        "restart, other changes are ignored")
+    new_cfg['setup'] = setup
+    if new_cfg.get('dimensions') != cfg.get('dimensions'):
+        logger.warning("Changes to dimensions need a restart, ignoring")
+        new_cfg['dimensions'] = cfg.get('dimensions')
+    old, new = cfg['loaders'], new_cfg['loaders']
+
+    for loadername in set(old) - set(new):
+        logger.info("Removing loader %s" % loadername)
+        if loadername in workers:
+            workers.pop(loadername).stop()
+
+    added = []
+    for loadername in new:
+        w = workers.get(loadername)
+        if w and dict(old[loadername], sql=None, interval=None) == \
+                dict(new[loadername], sql=None, interval=None):
+            # sql and interval can be swapped in place, keeping state
+            if old[loadername]['sql'] != new[loadername]['sql']:
+                logger.info("Updating SQL for loader %s" % loadername)
+                w.loader.sql = new[loadername]['sql']
+            w.interval = get_interval(new_cfg, loadername)
+            continue
+        if w:
+            logger.info("Recreating loader %s" % loadername)
+            workers.pop(loadername).stop()
+            # Wait for the current load to finish so the two loaders don't
+            # page the same table or write the same state files at once.
+            # Join with a timeout so signals are still handled meanwhile
+            while w.is_alive():
+                w.join(1)
+        else:
+            logger.info("Adding loader %s" % loadername)
+        try:
+            added.append(get_loader(loadername, new_cfg, engine, es, logger,
+                                    budget))
+        except Exception:
+            logger.exception("Failed creating loader %s" % loadername)
+    initialise(added, logger)
+    run(added, new_cfg)
+    return new_cfg
+
+def watch_config(path, cfg, engine, es, logger, budget=None):
+    """ Reload config on SIGHUP, or when the file changes if
+        config_watch_interval is set. Never returns.
+    """
+    watch_interval = cfg['setup'].get('config_watch_interval', 0)
+    mtime = os.path.getmtime(path)
+    last_check = time.time()
+    while True:
+        # Wait with a timeout so signals are still handled
+        reload_requested.wait(1)
+        if watch_interval and time.time() - last_check >= watch_interval:
+            last_check = time.time()
+            try:
+                if os.path.getmtime(path) != mtime:
+                    reload_requested.set()
+            except OSError:
+                pass
+        if reload_requested.is_set():
+            reload_requested.clear()
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                logger.error("Not reloading, %s is missing" % path)
+                continue
+            cfg = reload_config(path, cfg, engine, es, logger, budget)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+            description="Load Symphony DB tables into Elasticsearch")
+    parser.add_argument('config', nargs='?', default=CONFIG_FILE,
+            help="path to config file (default: %(default)s)")
+    parser.add_argument('--profile', metavar='LOADER', action='append',
+            default=[], help="profile this loader, e.g. session_history. "
+            "Can be given more than once. Send SIGUSR1 to profile again")
+    parser.add_argument('--profile-iterations', type=int, default=5,
+            metavar='N', help="number of load iterations to profile "
+            "(default: %(default)s)")
+    parser.add_argument('--profile-mode', choices=['cprofile', 'sampling'],
+            default='cprofile', help="deterministic cProfile or low "
+            "overhead stack sampling (default: %(default)s)")
+    parser.add_argument('--profile-dir', default='profiles',
+            help="directory to write profiles to (default: %(default)s)")
+    parser.add_argument('--reconcile', metavar='LOADER', nargs='*',
+            help="compare rows per day in the DB with docs in "
+            "Elasticsearch for these loaders (all if none given) and exit")
+    parser.add_argument('--reconcile-days', type=int, default=7,
+            metavar='N', help="number of days before today to reconcile, "
+            "today is still loading (default: %(default)s)")
+    parser.add_argument('--reload', action='store_true',
+            help="reload days that don't match when reconciling")
+    return parser.parse_args(argv)
+
+def reconcile(loaders, cfg, args):
+    """ Reconcile loaders and exit, non zero if any days don't match or
+        any of the loaders asked for don't exist
+    """
+    if args.reconcile:
+        unknown = set(args.reconcile) - set(l.name for l in loaders)
+        if unknown:
+            sys.exit("Unknown loaders to reconcile : %s" %
+                    ', '.join(sorted(unknown)))
+        loaders = [l for l in loaders if l.name in args.reconcile]
+    tables = dict((name, conf['table'])
+                    for name, conf in cfg['loaders'].iteritems()
+                    if 'table' in conf)
+    results = Reconciler(loaders, args.reconcile_days, args.reload,
+                        tables).run()
+    mismatched = sum(len(m) for m, _ in results.itervalues())
+    print("%d mismatched days in %d loaders" % (mismatched, len(loaders)))
+    sys.exit(1 if mismatched and not args.reload else 0)
+
 def main():
-    cfg = sys.argv[1] if len(sys.argv) > 1 else CONFIG_FILE
+    global profiler, profile_names, governor
+    args = parse_args(sys.argv[1:])
+    cfg_path = cfg = args.config
     if not os.path.isfile(cfg):
         sys.exit("%s does not exist or is not valid" % cfg)
     with open(cfg, 'r') as ymlfile:
-        cfg = yaml.load(ymlfile)
+        cfg = yaml.safe_load(ymlfile)
     setup = cfg['setup']
 
     # Set up logging
@@ -103,16 +336,16 @@ def main():
     logger.addHandler(sh)
     logger.info("Starting up with settings in %s" % CONFIG_FILE)
 
-    # Get a DB connection
-    for _ in range(setup['db_max_retries']):
+    # Get a DB connection, backing off exponentially between retries
+    for attempt in range(setup['db_max_retries']):
         engine = get_db_engine(setup['db_host'], setup['db_port'],
                 setup['db_name'], setup['db_user'], setup['db_pass'])
         if engine:
             logger.info("DB connection Initialised")
             break
 
-        logger.warning("Retrying connection to Elasticsearch")
-        time.sleep(setup['db_retry_wait'])
+        logger.warning("Retrying connection to Database")
+        time.sleep(setup['db_retry_wait'] * 2 ** attempt)
     else:
         logger.critical("Failed Connecting to Database")
         sys.exit(1)
@@ -126,27 +359,67 @@ def main():
 
     # Get an Elasticsearch connection
     es_hosts = setup['es_hosts'].split(',')
-    for _ in range(setup['es_max_retries']):
-        es = get_es_conn(es_hosts, setup['es_user'], setup['es_user'], 
-                setup['es_ssl'], setup['es_verify_certs'], setup['es_cacerts']) 
+    # Keep a connection open per bulk request in flight, plus some for
+    # searches and index creation
+    max_concurrency = setup.get('bulk_max_concurrency', DEFAULT_MAX_LIMIT)
+    maxsize = setup.get('es_maxsize', max_concurrency + 2)
+    for attempt in range(setup['es_max_retries']):
+        es = get_es_conn(es_hosts, setup['es_user'], setup['es_pass'], 
+                setup['es_ssl'], setup['es_verify_certs'], setup['es_cacerts'],
+                compress=setup.get('es_compress', False),
+                maxsize=maxsize,
+                sniff=setup.get('es_sniff', True),
+                timeout=setup.get('es_timeout', 10))
         if es:
             logger.info("Connected to Elasticsearch : %s" \
                 % es.info().get('cluster_name', 'unknown'))
             break
 
         logger.warning("Retrying connection to Elasticsearch")
-        time.sleep(setup['es_retry_wait'])
+        time.sleep(setup['es_retry_wait'] * 2 ** attempt)
     else:
         logger.critical("Failed Connecting to Elasticsearch")
         sys.exit(1)
 
-    # Build our list of SQL loaders
+    budget = None
+    if setup.get('memory_budget_mb'):
+        budget = MemoryBudget(setup['memory_budget_mb'] * 1024 * 1024)
+        logger.info("Loaders sharing a %dMB memory budget" %
+                    setup['memory_budget_mb'])
+
+    # Bulk requests from all loaders are paced by a shared governor
+    if setup.get('bulk_concurrency'):
+        governor = BackpressureGovernor(es,
+                initial=setup['bulk_concurrency'],
+                max_limit=max_concurrency,
+                target_latency=setup.get('bulk_target_latency', 2.0),
+                stats_interval=setup.get('bulk_stats_interval', 0))
+
+    # Dimension tables are loaded on first use and shared by all loaders
+    dimensions.update(get_dimensions(cfg, engine))
+
+    # Build our list of SQL loaders, they initialise in the background
     logger.info("Building list of loaders")
-    loaders = get_loaders(cfg, engine, es, logger) 
+    loaders = get_loaders(cfg, engine, es, logger, budget)
+
+    if args.reconcile is not None:
+        reconcile(loaders, cfg, args)
+
+    # Profile on request, either now or whenever SIGUSR1 is received
+    profiler = LoaderProfiler(args.profile_mode, args.profile_iterations,
+                            args.profile_dir)
+    profile_names = args.profile
+    if profile_names:
+        profiler.request(profile_names, [l.name for l in loaders])
+    signal.signal(signal.SIGUSR1, toggle_profiling)
 
     # We got all our configs, let's run now
     logger.info("Initialisation complete: let's do some ETL !")
-    run(loaders, setup['interval'])
+    run(loaders, cfg)
+
+    # Reload loaders on SIGHUP or when the config file changes
+    signal.signal(signal.SIGHUP, request_reload)
+    watch_config(cfg_path, cfg, engine, es, logger, budget)
 
 if __name__ == '__main__':
     main()
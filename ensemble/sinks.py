@@ -0,0 +1,343 @@
+#
+# (c) 2015, Excelian Ltd
+#
+
+import datetime
+import gzip
+import logging
+import os
+import Queue
+import socket
+import threading
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+from helpers import write_atomic
+
+module_name = 'Ensemble.sinks'
+module_logger = logging.getLogger(module_name)
+
+def get_records(actions):
+    """ Turn bulk actions into records for sinks
+
+    :param actions: list of bulk actions
+    :returns: list of dicts with the doc's index, id and source
+    """
+    return [{"_index": a['_index'],
+             "_id": a.get('_id'),
+             "_source": a['_source'] if '_source' in a else a.get('doc')}
+            for a in actions]
+
+class Sink(object):
+    """ Base class for extra destinations for a loader's docs
+
+    Elasticsearch stays the loader's primary destination. Sinks are sent
+    the same docs from the same fetch, so another destination doesn't mean
+    another read against the DB.
+
+    Each sink writes on its own thread from a bounded queue so a slow or
+    broken sink doesn't hold up the loader or the other sinks. Batches that
+    don't fit in the queue are spooled to disk in state_dir and written
+    once the sink catches up. A batch that fails is retried, with backoff,
+    until it goes through, and the sequence number of the last batch
+    written is persisted as the sink's checkpoint. Batches still queued
+    when the sink is closed are spooled, but are lost if the process is
+    killed.
+
+    Subclasses implement write().
+
+    """
+    def __init__(self, name, loader_name, state_dir=None, max_pending=10,
+                    retry_wait=1, max_retry_wait=60):
+        """
+        :param name: sink name, unique for the loader
+        :param loader_name: name of the loader feeding the sink
+        :param state_dir: directory for the checkpoint and spool files.
+            Batches that don't fit in the queue are dropped if not set
+        :param max_pending: batches to hold in memory before spooling
+        :param retry_wait: initial seconds to wait before rewriting a
+            batch, doubled on every retry
+        :param max_retry_wait: most seconds to wait between retries
+        """
+        self.name = name
+        self.loader_name = loader_name
+        self.retry_wait = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.queue = Queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.serializer = JSONSerializer()
+        self.logger = logging.getLogger("%s.%s.%s" % (module_name,
+                                                    loader_name, name))
+        self.checkpoint = None
+        self.checkpoint_path = self.spool_path = self.draining_path = None
+        if state_dir:
+            prefix = os.path.join(state_dir, "%s.%s" % (loader_name, name))
+            self.checkpoint_path = prefix + '.checkpoint'
+            self.spool_path = prefix + '.spool.jsonl'
+            self.draining_path = prefix + '.draining.jsonl'
+            if os.path.isfile(self.checkpoint_path):
+                with open(self.checkpoint_path) as f:
+                    self.checkpoint = int(f.read())
+        # Once batches are spooled, later batches are spooled too until
+        # the spool is written, so they stay in order
+        self.spilling = bool(self.spool_path) and (
+                            os.path.isfile(self.spool_path) or
+                            os.path.isfile(self.draining_path))
+        # Batch the thread was writing when it was stopped
+        self.undelivered = None
+        # Highest sequence number sent, whether written yet or not
+        self.sent = self.checkpoint
+        if self.spilling:
+            for path in (self.draining_path, self.spool_path):
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        for line in f:
+                            self.sent = max(self.sent,
+                                        self.serializer.loads(line)['seq'])
+
+    def __str__(self):
+        return "%s sink for %s" % (self.name, self.loader_name)
+
+    def write(self, records):
+        """ Write a batch of records, raising an exception on failure
+
+        :param records: list of record dicts
+        """
+        raise NotImplementedError
+
+    def start(self):
+        """ Start writing batches in the background """
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name=str(self))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, records, seq):
+        """ Queue a batch of records to be written. Never blocks
+
+        :param records: list of record dicts
+        :param seq: largest sequence number in the batch
+        """
+        with self.lock:
+            self.sent = max(seq, self.sent)
+            if not self.spilling:
+                try:
+                    self.queue.put_nowait((records, seq))
+                    return
+                except Queue.Full:
+                    if not self.spool_path:
+                        self.logger.error("Queue full, dropping %d records "
+                                        "up to %s" % (len(records), seq))
+                        return
+                    self.logger.warning("Queue full, spooling to %s" %
+                                        self.spool_path)
+                    self.spilling = True
+            self._spool([(records, seq)])
+
+    def close(self):
+        """ Stop writing and spool whatever is still queued so it is
+            written after a restart
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            pending = [self.undelivered] if self.undelivered else []
+            self.undelivered = None
+            while True:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if not pending:
+                return
+            if not self.spool_path:
+                self.logger.error("Dropping %d unwritten batches" %
+                                    len(pending))
+                return
+            # Queued batches came before anything already spooled
+            spooled = ''
+            if os.path.isfile(self.spool_path):
+                with open(self.spool_path) as f:
+                    spooled = f.read()
+            write_atomic(self.spool_path, ''.join(
+                            self._dumps({"seq": seq, "records": records})
+                            for records, seq in pending) + spooled)
+            self.spilling = True
+            self.logger.info("Spooled %d unwritten batches" % len(pending))
+
+    def _dumps(self, data):
+        # Non-ascii docs are serialised to unicode
+        line = self.serializer.dumps(data)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        return line + '\n'
+
+    def _spool(self, batches):
+        directory = os.path.dirname(self.spool_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.spool_path, 'a') as f:
+            for records, seq in batches:
+                f.write(self._dumps({"seq": seq, "records": records}))
+
+    def _save_checkpoint(self, seq):
+        self.checkpoint = max(seq, self.checkpoint)
+        if self.checkpoint_path:
+            write_atomic(self.checkpoint_path, str(self.checkpoint))
+
+    def _deliver(self, records, seq):
+        """ Write a batch, retrying until it succeeds or the sink is stopped
+
+        :returns: True if the batch was written
+        """
+        wait = self.retry_wait
+        while True:
+            try:
+                self.write(records)
+                break
+            except Exception, err:
+                self.logger.warning("Unable to write %d records, retrying in "
+                                    "%s seconds : %s" %
+                                    (len(records), wait, err))
+            if self.stopped.wait(wait):
+                return False
+            wait = min(wait * 2, self.max_retry_wait)
+        self._save_checkpoint(seq)
+        return True
+
+    def _drain_spool(self):
+        """ Write spooled batches, oldest first """
+        with self.lock:
+            if not self.spilling:
+                return
+            if not os.path.isfile(self.draining_path):
+                if not os.path.isfile(self.spool_path):
+                    # Everything spooled has been written
+                    self.spilling = False
+                    return
+                # New batches go to a fresh spool while this one is written
+                os.rename(self.spool_path, self.draining_path)
+        with open(self.draining_path) as f:
+            lines = f.readlines()
+        self.logger.info("Writing %d spooled batches" % len(lines))
+        for i, line in enumerate(lines):
+            batch = self.serializer.loads(line)
+            if not self._deliver(batch['records'], batch['seq']):
+                # Keep what's left for next time
+                write_atomic(self.draining_path, ''.join(lines[i:]))
+                return
+        os.remove(self.draining_path)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                records, seq = self.queue.get(timeout=1)
+            except Queue.Empty:
+                try:
+                    self._drain_spool()
+                except (IOError, OSError, SerializationError), err:
+                    self.logger.error("Unable to read spool : %s" % err)
+                    self.stopped.wait(self.max_retry_wait)
+                continue
+            if not self._deliver(records, seq):
+                self.undelivered = (records, seq)
+
+class FileSink(Sink):
+    """ Writes records as gzipped JSON lines, one file per loader per day
+        of the docs' TIME_STAMP, so replayed or caught up docs land with
+        the rest of their day
+
+    Every batch is appended as a separate gzip member, which gzip and most
+    data lake tools read as one stream.
+
+    """
+    def __init__(self, name, loader_name, path='.', **kwargs):
+        """
+        :param path: directory to write the files to
+        """
+        super(FileSink, self).__init__(name, loader_name, **kwargs)
+        self.path = path
+
+    @staticmethod
+    def _get_day(record):
+        """ YYYYMMDD of a record's TIME_STAMP, today if it has none """
+        timestamp = (record.get('_source') or {}).get('TIME_STAMP')
+        if isinstance(timestamp, datetime.date):
+            return timestamp.strftime('%Y%m%d')
+        if timestamp:
+            # Spooled records have ISO format strings
+            return timestamp[:10].replace('-', '')
+        return datetime.datetime.utcnow().strftime('%Y%m%d')
+
+    def write(self, records):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        days = {}
+        for r in records:
+            days.setdefault(self._get_day(r), []).append(r)
+        for day, day_records in sorted(days.iteritems()):
+            filename = os.path.join(self.path, "%s-%s.jsonl.gz" %
+                                    (self.loader_name, day))
+            data = ''.join(self._dumps(r) for r in day_records)
+            with gzip.open(filename, 'ab') as f:
+                f.write(data)
+
+class SocketSink(Sink):
+    """ Sends records as newline delimited JSON over a TCP connection,
+        e.g. to a message queue bridge or a local alerting service
+
+    """
+    def __init__(self, name, loader_name, host='localhost', port=5140,
+                    timeout=30, **kwargs):
+        """
+        :param host: host to connect to
+        :param port: port to connect to
+        :param timeout: seconds to wait connecting or sending
+        """
+        super(SocketSink, self).__init__(name, loader_name, **kwargs)
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock = None
+
+    def write(self, records):
+        data = ''.join(self._dumps(r) for r in records)
+        try:
+            if not self.sock:
+                self.sock = socket.create_connection(self.address,
+                                                    self.timeout)
+            self.sock.sendall(data)
+        except socket.error:
+            # Reconnect on the next attempt
+            if self.sock:
+                self.sock.close()
+            self.sock = None
+            raise
+
+    def close(self):
+        super(SocketSink, self).close()
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+SINKS = {
+    'file': FileSink,
+    'socket': SocketSink,
+}
+
+def get_sink(loader_name, cfg, state_dir=None):
+    """ Build a sink from a loader's sinks config entry
+
+    :param loader_name: name of the loader feeding the sink
+    :param cfg: dict with the sink type, an optional name (defaults to the
+        type) and the sink's own settings
+    :param state_dir: directory for checkpoint and spool files
+    """
+    cfg = dict(cfg)
+    sink_type = cfg.pop('type')
+    name = cfg.pop('name', sink_type)
+    return SINKS[sink_type](name, loader_name, state_dir=state_dir, **cfg)
@@ -0,0 +1,199 @@
+""" Fakes shared by the tests, standing in for the DB, Elasticsearch,
+    sinks and loaders
+"""
+import datetime
+import json
+import shutil
+import tempfile
+import threading
+import unittest2 as unittest
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import NotFoundError
+from ensemble.sinks import Sink
+
+SQL = "SELECT TOP (?) * FROM [T] WHERE [INSERT_SEQ] > ? ORDER BY INSERT_SEQ"
+
+ES_CONFIG = {
+    'template_name': 'test',
+    'all_index': 'test',
+    'index_rollover': 'daily',
+    'template_body': {},
+}
+
+def make_rows(seqs, timestamp=datetime.datetime(2016, 11, 25, 10, 0)):
+    return [{'INSERT_SEQ': i, 'TIME_STAMP': timestamp} for i in seqs]
+
+class TempDirTestCase(unittest.TestCase):
+    """ Test case with a scratch directory in self.tmpdir """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class FakeResult(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+class FakeEngine(object):
+    """ Serves rows for `... WHERE INSERT_SEQ > ?` dimension queries,
+        `SELECT TOP (?) ... WHERE INSERT_SEQ > ?`,
+        `... WHERE (INSERT_SEQ BETWEEN ? AND ? OR ...)`,
+        `... WHERE TIME_STAMP IN (?, ...) AND INSERT_SEQ > ?` and time
+        windows after a (TIME_STAMP, INSERT_SEQ) position. Any other query gets
+        result
+    """
+    def __init__(self, rows=None, result=None):
+        self.rows = rows or []
+        self.result = result
+        self.queries = []
+
+    def execute(self, sql, params):
+        self.queries.append(params)
+        if self.result is not None:
+            return FakeResult(self.result)
+        if 'IN (' in sql:
+            # Rollup samples, TIME_STAMP in (...) after a sequence number
+            top, timestamps, seq = params[0], params[1:-1], params[-1]
+            return FakeResult([r for r in self.rows
+                                if r['TIME_STAMP'] in timestamps and
+                                r['INSERT_SEQ'] > seq][:top])
+        if len(params) == 1:
+            return FakeResult([r for r in self.rows
+                                if r['INSERT_SEQ'] > params[0]])
+        if len(params) == 6:
+            top, start, end, ts, _, seq = params
+            rows = sorted(self.rows,
+                        key=lambda r: (r['TIME_STAMP'], r['INSERT_SEQ']))
+            return FakeResult([r for r in rows
+                        if start <= r['TIME_STAMP'] < end and
+                        (r['TIME_STAMP'], r['INSERT_SEQ']) > (ts, seq)][:top])
+        if len(params) == 2:
+            ranges = [(params[1] + 1, float('inf'))]
+        else:
+            ranges = zip(params[1::2], params[2::2])
+        return FakeResult([r for r in self.rows
+                            if any(start <= r['INSERT_SEQ'] <= end
+                                    for start, end in ranges)][:params[0]])
+
+class FakeIndices(object):
+    def __init__(self):
+        self.created = []
+
+    def exists_template(self, name):
+        return True
+
+    def exists(self, index):
+        return index in self.created
+
+    def create(self, index, **kwargs):
+        self.created.append(index)
+
+class FakeCluster(object):
+    def __init__(self):
+        self.timed_out = False
+        self.checked = []
+
+    def health(self, index, **kwargs):
+        self.checked.append(index)
+        return {'status': 'yellow', 'timed_out': self.timed_out}
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+class FakeES(object):
+    """ Minimal Elasticsearch client. statuses maps a document id to the
+        list of statuses returned for its next bulk items. Sources of
+        loaded docs are kept in docs by (index, id). Searches return
+        search_result, or 404 if it isn't set
+    """
+    def __init__(self, statuses=None, search_result=None):
+        self.indices = FakeIndices()
+        self.cluster = FakeCluster()
+        self.transport = FakeTransport()
+        self.statuses = statuses or {}
+        self.search_result = search_result
+        self.searches = []
+        self.requests = []
+        self.docs = {}
+
+    def search(self, index, body, **kwargs):
+        self.searches.append(body)
+        if self.search_result is None:
+            raise NotFoundError(404, 'index_not_found_exception')
+        return self.search_result
+
+    def bulk(self, body, **kwargs):
+        lines = body.strip().split('\n')
+        actions = [json.loads(l) for l in lines[::2]]
+        self.requests.append(actions)
+        items = []
+        for action, source in zip(actions, lines[1::2]):
+            op_type, meta = action.items()[0]
+            self.docs[meta['_index'], meta['_id']] = json.loads(source)
+            statuses = self.statuses.get(meta['_id'], [])
+            status = statuses.pop(0) if statuses else 201
+            items.append({op_type: dict(meta, status=status)})
+        return {'items': items}
+
+class RecordingSink(object):
+    """ Sink that records what it is sent without a thread """
+    def __init__(self, sent=None):
+        self.sent = sent
+        self.batches = []
+        self.records = []
+        self.started = False
+
+    def send(self, records, seq):
+        self.batches.append(([r['_id'] for r in records], seq))
+        self.records.extend(records)
+
+    def start(self):
+        self.started = True
+
+    def close(self):
+        pass
+
+class FlakySink(Sink):
+    """ Records written batches, failing until ok is set """
+    def __init__(self, *args, **kwargs):
+        super(FlakySink, self).__init__(*args, **kwargs)
+        self.written = []
+        self.ok = threading.Event()
+
+    def write(self, records):
+        if not self.ok.is_set():
+            raise IOError("sink down")
+        self.written.append(records)
+
+class FakeLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(msg)
+
+    warning = error = exception = info
+
+class FakeLoader(object):
+    def __init__(self, name, sql='sql'):
+        self.name = name
+        self.sql = sql
+        self.logger = FakeLogger()
+        self.loads = 0
+        self.closes = 0
+        self.closed = threading.Event()
+
+    def initialise(self):
+        pass
+
+    def load(self):
+        self.loads += 1
+        return sum(range(10000))
+
+    def close(self):
+        self.closes += 1
+        self.closed.set()
@@ -0,0 +1,29 @@
+import threading
+import time
+import unittest2 as unittest
+from ensemble.budget import MemoryBudget
+
+class MemoryBudget_test(unittest.TestCase):
+    def test_reserve_shrinks_to_what_is_free(self):
+        budget = MemoryBudget(1000)
+        self.assertEqual(budget.reserve(700), 700)
+        self.assertEqual(budget.reserve(700, min_bytes=100), 300)
+        self.assertEqual(budget.utilisation(), 1.0)
+
+    def test_reserve_times_out_below_minimum(self):
+        budget = MemoryBudget(1000)
+        budget.reserve(950)
+        self.assertEqual(budget.reserve(500, min_bytes=100, timeout=0.01), 0)
+
+    def test_reserve_blocks_until_released(self):
+        budget = MemoryBudget(1000)
+        budget.reserve(1000)
+        granted = []
+        t = threading.Thread(target=lambda: granted.append(
+                                budget.reserve(400, min_bytes=400)))
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(granted, [])
+        budget.release(500)
+        t.join(1)
+        self.assertEqual(granted, [400])
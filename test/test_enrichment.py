@@ -0,0 +1,61 @@
+import threading
+import unittest2 as unittest
+from ensemble.enrichment import DimensionCache, Enricher
+from fakes import FakeEngine
+
+class DimensionCache_test(unittest.TestCase):
+    def setUp(self):
+        self.engine = FakeEngine([
+            {'CONSUMER_NAME': '/A', 'RESOURCE_GROUP': 'rg1', 'INSERT_SEQ': 1},
+            {'CONSUMER_NAME': '/B', 'RESOURCE_GROUP': 'rg2', 'INSERT_SEQ': 2},
+        ])
+        self.cache = DimensionCache('consumers', self.engine, 'sql',
+                                    'CONSUMER_NAME', refresh=10, ttl=100)
+
+    def test_refresh_is_incremental_until_ttl(self):
+        self.cache.refresh_if_due(now=1000)
+        self.engine.rows.append(
+            {'CONSUMER_NAME': '/A', 'RESOURCE_GROUP': 'rg3', 'INSERT_SEQ': 3})
+        self.cache.refresh_if_due(now=1005)
+        self.cache.refresh_if_due(now=1010)
+        self.cache.refresh_if_due(now=1100)
+        self.assertEqual(self.engine.queries, [(-1,), (2,), (-1,)])
+        self.assertEqual(self.cache.get('/A'), {'RESOURCE_GROUP': 'rg3'})
+
+    def test_first_load_is_waited_for(self):
+        loading, release = threading.Event(), threading.Event()
+        execute = self.engine.execute
+        def slow_execute(sql, params):
+            loading.set()
+            release.wait(5)
+            return execute(sql, params)
+        self.engine.execute = slow_execute
+        first = threading.Thread(target=self.cache.refresh_if_due,
+                                args=(1000,))
+        first.start()
+        loading.wait(5)
+        found = []
+        second = threading.Thread(target=lambda: (
+                    self.cache.refresh_if_due(1000),
+                    found.append(self.cache.get('/A'))))
+        second.start()
+        second.join(0.1)
+        self.assertTrue(second.is_alive())
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(found, [{'RESOURCE_GROUP': 'rg1'}])
+        self.assertEqual(self.engine.queries, [(-1,)])
+        # Once loaded, a busy refresh is skipped rather than waited for
+        self.cache.lock.acquire()
+        self.cache.refresh_if_due(now=1010)
+        self.cache.lock.release()
+        self.assertEqual(self.engine.queries, [(-1,)])
+
+    def test_enricher_stamps_prefixed_fields(self):
+        self.cache.refresh_if_due(now=1000)
+        enricher = Enricher(self.cache, 'CONSUMER_NAME', 'CONSUMER_')
+        self.assertEqual(enricher.enrich({'CONSUMER_NAME': '/B'}),
+                {'CONSUMER_NAME': '/B', 'CONSUMER_RESOURCE_GROUP': 'rg2'})
+        self.assertEqual(enricher.enrich({'CONSUMER_NAME': '/C'}),
+                {'CONSUMER_NAME': '/C'})
@@ -0,0 +1,28 @@
+import unittest2 as unittest
+from ensemble.gaps import GapTracker
+
+class GapTracker_test(unittest.TestCase):
+    def test_observe_records_missing_ranges(self):
+        gaps = GapTracker()
+        self.assertEqual(gaps.observe(10, [11, 14, 15, 20], now=1), 2)
+        self.assertEqual(list(gaps), [(12, 13), (16, 19)])
+
+    def test_fill_splits_gaps(self):
+        gaps = GapTracker()
+        gaps.observe(0, [10], now=1)
+        gaps.fill([1, 5, 9])
+        self.assertEqual(list(gaps), [(2, 4), (6, 8)])
+
+    def test_fill_finds_the_gap_of_each_seq(self):
+        gaps = GapTracker()
+        gaps.observe(0, [5, 10, 20], now=1)
+        gaps.fill([0, 3, 5, 12, 12, 19, 25])
+        self.assertEqual(list(gaps), [(1, 2), (4, 4), (6, 9), (11, 11),
+                                    (13, 18)])
+
+    def test_expire_old_gaps(self):
+        gaps = GapTracker(max_age=100)
+        gaps.observe(0, [5], now=1)
+        gaps.observe(5, [10], now=50)
+        self.assertEqual(gaps.expire(now=101), [(1, 4)])
+        self.assertEqual(list(gaps), [(6, 9)])
@@ -0,0 +1,39 @@
+import threading
+import time
+import unittest2 as unittest
+from ensemble.governor import BackpressureGovernor
+
+class BackpressureGovernor_test(unittest.TestCase):
+    def test_limit_grows_and_is_cut(self):
+        governor = BackpressureGovernor(initial=2, max_limit=4,
+                                        target_latency=1)
+        for _ in range(20):
+            governor.acquire('a')
+            governor.release(0.1)
+        self.assertEqual(governor.limit, 4)
+        governor.acquire('a')
+        governor.release(0.1, rejected=True)
+        self.assertEqual(governor.limit, 2)
+        # Only cut once per target latency
+        governor.acquire('a')
+        governor.release(5)
+        self.assertEqual(governor.limit, 2)
+
+    def test_permits_shared_by_weight(self):
+        governor = BackpressureGovernor(initial=1, max_limit=1)
+        governor.acquire('holder')
+        order = []
+        def send(name, weight):
+            governor.acquire(name, weight)
+            order.append(name)
+            governor.release(0)
+        threads = []
+        for name, weight in [('light', 1)] * 3 + [('heavy', 4)] * 3:
+            t = threading.Thread(target=send, args=(name, weight))
+            t.start()
+            threads.append(t)
+            time.sleep(0.01)
+        governor.release(0)
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order[:4], ['heavy', 'heavy', 'heavy', 'light'])
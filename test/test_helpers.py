@@ -2,9 +2,16 @@ import string
 import random
 import logging
 import sys
+import gzip
+from cStringIO import StringIO
 import sqlalchemy
 import unittest2 as unittest
-from ensemble.helpers import get_db_engine, get_es_conn
+from ensemble.helpers import (
+        get_db_engine,
+        get_es_conn,
+        CompressedHttpConnection,
+        transport_stats
+)
 
 class Helper_test(unittest.TestCase):
     def setUp(self):
@@ -23,3 +30,35 @@ class Helper_test(unittest.TestCase):
 
     def test_get_es_conn_empty_hostlist(self):
         self.assertFalse(get_es_conn(es_hostlist=[], logger_name="Test"))
+
+class FakeResponse(object):
+    status = 200
+    data = '{}'
+
+    def getheaders(self):
+        return {}
+
+class FakePool(object):
+    def __init__(self):
+        self.requests = []
+
+    def urlopen(self, method, url, body, retries, headers, **kwargs):
+        self.requests.append((body, headers))
+        return FakeResponse()
+
+class CompressedHttpConnection_test(unittest.TestCase):
+    def test_gzips_bodies_and_counts_bytes_per_tag(self):
+        conn = CompressedHttpConnection(compress=True)
+        conn.pool = FakePool()
+        body = '{"index": {}}\n{"SESSION_NAME": "test"}\n' * 100
+        with transport_stats.tagged('compress_test'):
+            conn.perform_request('POST', '/_bulk', body=body)
+        conn.perform_request('GET', '/')
+
+        (sent, headers), (_, get_headers) = conn.pool.requests
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(sent)).read(), body)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertNotIn('content-encoding', get_headers)
+        self.assertEqual(transport_stats.get('compress_test'),
+                        (1, len(body), len(sent)))
+        self.assertLess(len(sent), len(body) / 10)
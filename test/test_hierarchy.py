@@ -0,0 +1,30 @@
+import unittest2 as unittest
+from ensemble.hierarchy import ConsumerTree
+
+class ConsumerTree_test(unittest.TestCase):
+    def setUp(self):
+        self.tree = ConsumerTree(['USED'])
+
+    def totals(self, sample):
+        return dict((path, (depth, leaves, totals['USED']))
+                    for path, depth, leaves, totals in self.tree.totals(sample))
+
+    def test_totals_each_level(self):
+        self.tree.add(1, '/Root/BU1/App1', {'USED': 2})
+        self.tree.add(1, '/Root/BU1/App2', {'USED': 3})
+        self.tree.add(1, '/Root/BU2', {'USED': None})
+        self.tree.add(2, '/Root/BU1/App1', {'USED': 7})
+        self.assertEqual(self.totals(1), {
+            '/': (0, 3, 5),
+            '/Root': (1, 3, 5),
+            '/Root/BU1': (2, 2, 5),
+            '/Root/BU1/App1': (3, 1, 2),
+            '/Root/BU1/App2': (3, 1, 3),
+            '/Root/BU2': (2, 1, 0),
+        })
+        self.assertEqual(self.totals(2)['/'], (0, 1, 7))
+
+    def test_parent_rows_are_not_double_counted(self):
+        self.tree.add(1, '/Root/BU1', {'USED': 5})
+        self.tree.add(1, '/Root/BU1/App1', {'USED': 2})
+        self.assertEqual(self.totals(1)['/Root'], (1, 1, 2))
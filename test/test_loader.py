@@ -0,0 +1,394 @@
+import datetime
+import json
+import os
+from ensemble.budget import MemoryBudget
+from ensemble.loader import (
+        Loader,
+        ResourceMetricsLoader,
+        SessionHistoryLoader
+)
+from fakes import (
+        ES_CONFIG,
+        SQL,
+        FakeEngine,
+        FakeES,
+        FlakySink,
+        RecordingSink,
+        TempDirTestCase,
+        make_rows
+)
+
+def make_actions(n):
+    return [{'_index': 'test', '_type': 'default', '_id': i,
+                '_source': {'INSERT_SEQ': i}} for i in range(n)]
+
+class Loader_test(TempDirTestCase):
+    def make_loader(self, es, **kwargs):
+        return Loader(None, es, es_config=ES_CONFIG, bulk_retry_wait=0,
+                        dead_letter_dir=self.tmpdir, **kwargs)
+
+    def test_bulk_retries_only_rejected_items(self):
+        es = FakeES({1: [429], 3: [503, 429]})
+        loader = self.make_loader(es)
+        success, errors = loader._bulk(make_actions(5))
+        self.assertEqual(success, 5)
+        self.assertEqual(errors, [])
+        resent = [[a['index']['_id'] for a in r] for r in es.requests]
+        self.assertEqual(resent, [[0, 1, 2, 3, 4], [1, 3], [3]])
+
+    def test_bulk_dead_letters_exhausted_and_rejected_items(self):
+        es = FakeES({1: [429, 429, 429], 2: [400]})
+        loader = self.make_loader(es, bulk_max_retries=2)
+        success, errors = loader._bulk(make_actions(3))
+        self.assertEqual(success, 1)
+        self.assertEqual(len(errors), 2)
+        filename, = os.listdir(self.tmpdir)
+        self.assertRegexpMatches(filename, r'^test-\d{8}\.jsonl$')
+        with open(os.path.join(self.tmpdir, filename)) as f:
+            dead = [json.loads(l) for l in f]
+        self.assertEqual(sorted(d['action']['_id'] for d in dead), [1, 2])
+
+    def test_resource_metrics_doc_id_is_deterministic(self):
+        ts = datetime.datetime(2016, 11, 25, 10, 30)
+        first = ResourceMetricsLoader._get_doc_id('host1', ts)
+        self.assertEqual(first, ResourceMetricsLoader._get_doc_id('host1', ts))
+        self.assertNotEqual(first,
+                ResourceMetricsLoader._get_doc_id('host2', ts))
+
+    def test_next_period_monthly_wraps_year(self):
+        loader = self.make_loader(FakeES())
+        loader.index_rollover = 'monthly'
+        self.assertEqual(
+                loader._next_period(datetime.datetime(2016, 12, 31, 23, 59)),
+                datetime.datetime(2017, 1, 1))
+
+    def test_precreate_next_index_only_near_rollover(self):
+        es = FakeES()
+        loader = self.make_loader(es, precreate_ahead=600)
+        loader._precreate_indices(datetime.datetime(2016, 11, 25, 12, 0))
+        self.assertEqual(es.indices.created, ['test-25112016'])
+        loader._precreate_indices(datetime.datetime(2016, 11, 25, 23, 55))
+        loader._precreate_indices(datetime.datetime(2016, 11, 25, 23, 56))
+        self.assertEqual(es.indices.created,
+                        ['test-25112016', 'test-26112016'])
+        self.assertIn('test-26112016', loader.known_indices)
+
+    def test_precreate_waits_once_and_creates_rollup_indices(self):
+        from ensemble.index_config.consumer_demand import config
+        es = FakeES()
+        es.cluster.timed_out = True
+        loader = Loader(None, es, es_config=config, sql=SQL, rollup=True)
+        now = datetime.datetime(2016, 11, 25, 12, 0)
+        loader._precreate_indices(now)
+        self.assertEqual(es.indices.created, ['consumer_demand-25112016',
+                                        'rollup_consumer_demand-25112016'])
+        # Allocation timed out but the indices aren't waited on again
+        loader._precreate_indices(now)
+        self.assertEqual(len(es.cluster.checked), 2)
+
+    def test_load_shrinks_pages_to_memory_budget(self):
+        es = FakeES()
+        engine = FakeEngine(make_rows(range(10)))
+        budget = MemoryBudget(4 * 3 * 100)
+        loader = Loader(engine, es, es_config=ES_CONFIG, max_rows=8,
+                        min_rows=1, memory_budget=budget, precreate_ahead=0)
+        loader.row_bytes = 100
+        loader._measure_rows = lambda sqldata: None
+        self.assertTrue(loader.load())
+        self.assertEqual(engine.queries, [(4, -1), (4, 3), (4, 7)])
+        self.assertEqual(loader.seq, 9)
+        self.assertEqual(budget.used, 0)
+
+    def test_session_history_derived_metrics(self):
+        loader = SessionHistoryLoader(None, FakeES(), es_config=ES_CONFIG)
+        start = datetime.datetime(2016, 11, 25, 10, 0)
+        bodies = loader._preprocess_batch([
+            {'CREATE_TIME': start,
+                'END_TIME': start + datetime.timedelta(minutes=2),
+                'NUM_TASK_DONE': 8, 'NUM_TASK_ERROR': 2,
+                'TOTAL_UNSUCCESS_TASKRUNS': 2,
+                'TOTAL_TASKS_RUNTIME': 40.0,
+                'TOTAL_TASKS_SUBMIT2START_TIME': 5.0},
+            {'CREATE_TIME': start, 'END_TIME': None,
+                'NUM_TASK_DONE': 0, 'NUM_TASK_ERROR': 0,
+                'TOTAL_UNSUCCESS_TASKRUNS': 0,
+                'TOTAL_TASKS_RUNTIME': 0.0,
+                'TOTAL_TASKS_SUBMIT2START_TIME': None},
+        ])
+        self.assertEqual(bodies[0]['SESSION_DURATION'], 120.0)
+        self.assertEqual(bodies[0]['AVG_TASK_RUNTIME'], 5.0)
+        self.assertEqual(bodies[0]['AVG_SUBMIT2START_TIME'], 0.5)
+        self.assertEqual(bodies[0]['TASK_FAILURE_RATIO'], 0.2)
+        for field in ('SESSION_DURATION', 'AVG_TASK_RUNTIME',
+                        'AVG_SUBMIT2START_TIME', 'TASK_FAILURE_RATIO'):
+            self.assertNotIn(field, bodies[1])
+
+    def test_load_refetches_late_rows_in_gaps(self):
+        es = FakeES()
+        engine = FakeEngine(make_rows([1, 2, 5, 6]))
+        loader = Loader(engine, es, es_config=ES_CONFIG, sql=SQL,
+                        max_rows=2, precreate_ahead=0,
+                        state_dir=self.tmpdir)
+        loader.load()
+        self.assertEqual(list(loader.gaps), [(3, 4)])
+        # Row 4 commits late, below the sequence number
+        engine.rows.extend(make_rows([4, 7]))
+        engine.rows.sort(key=lambda r: r['INSERT_SEQ'])
+        loader.load()
+        self.assertEqual(list(loader.gaps), [(3, 3)])
+        self.assertEqual(loader.seq, 7)
+        loaded = sorted(a['index']['_id'] for r in es.requests for a in r)
+        self.assertEqual(loaded, [1, 2, 4, 5, 6, 7])
+        # Gaps survive a restart
+        restarted = Loader(engine, es, es_config=ES_CONFIG, sql=SQL,
+                            state_dir=self.tmpdir)
+        self.assertEqual(list(restarted.gaps), [(3, 3)])
+
+    def test_load_fans_out_to_sinks_and_catches_them_up(self):
+        engine = FakeEngine(make_rows(range(1, 8)))
+        behind, new = RecordingSink(2), RecordingSink(None)
+        loader = Loader(engine, FakeES(), es_config=ES_CONFIG, sql=SQL,
+                        max_rows=10, precreate_ahead=0, gap_max_age=0,
+                        sinks=[behind, new])
+        # Elasticsearch has up to 4 but the first sink only up to 2
+        loader._find_last_seq = lambda index_name: 4
+        loader.load()
+        self.assertTrue(behind.started and new.started)
+        self.assertEqual(behind.batches, [([3, 4], 4), ([5, 6, 7], 7)])
+        self.assertEqual(new.batches, [([5, 6, 7], 7)])
+        # Reloads aren't sent to sinks again
+        loader.reload_range(1, 7)
+        self.assertEqual(len(new.batches), 1)
+
+    def test_sinks_catch_up_on_first_load_within_budget(self):
+        engine = FakeEngine(make_rows(range(1, 8)))
+        sink = RecordingSink(2)
+        budget = MemoryBudget(4 * 3 * 100)
+        loader = Loader(engine, FakeES(), es_config=ES_CONFIG, sql=SQL,
+                        max_rows=10, min_rows=1, precreate_ahead=0,
+                        gap_max_age=0, sinks=[sink], memory_budget=budget)
+        loader.row_bytes = 100
+        loader._measure_rows = lambda sqldata: None
+        loader._find_last_seq = lambda index_name: 7
+        loader.initialise()
+        self.assertEqual(sink.batches, [])
+        loader.load()
+        # Pages of the 4 rows the budget allows
+        self.assertEqual(sink.batches, [([3, 4, 5, 6], 6), ([7], 7)])
+        self.assertEqual(engine.queries[:2], [(4, 3, 7), (4, 7, 7)])
+        self.assertEqual(budget.used, 0)
+
+    def test_sinks_resume_from_spool_after_restart(self):
+        def make_loader(sink, seq):
+            loader = Loader(engine, FakeES(), es_config=ES_CONFIG, sql=SQL,
+                            max_rows=10, precreate_ahead=0, gap_max_age=0,
+                            sinks=[sink])
+            loader._find_last_seq = lambda index_name: seq
+            return loader
+
+        engine = FakeEngine(make_rows(range(1, 8)))
+        with open(os.path.join(self.tmpdir, 'test.flaky.checkpoint'),
+                    'w') as f:
+            f.write('2')
+        # The sink is down, so rows 3 to 7 are spooled on shutdown
+        sink = FlakySink('flaky', 'test', state_dir=self.tmpdir,
+                        retry_wait=0.01)
+        loader = make_loader(sink, 2)
+        loader.load()
+        loader.close()
+        self.assertEqual(sink.checkpoint, 2)
+
+        sink = FlakySink('flaky', 'test', state_dir=self.tmpdir,
+                        retry_wait=0.01)
+        sink.ok.set()
+        loader = make_loader(sink, 7)
+        loader.load()
+        for _ in range(100):
+            if sink.checkpoint == 7:
+                break
+            sink.stopped.wait(0.05)
+        loader.close()
+        self.assertEqual([r['_id'] for records in sink.written
+                            for r in records], [3, 4, 5, 6, 7])
+
+    def test_time_windows_follow_index_days_and_reread_overlap(self):
+        def row(seq, day, hour, minute=0):
+            return {'INSERT_SEQ': seq, 'TIME_STAMP':
+                    datetime.datetime(2016, 11, day, hour, minute)}
+        es = FakeES()
+        engine = FakeEngine([row(1, 25, 10), row(3, 25, 11), row(2, 25, 23),
+                            row(4, 26, 1)])
+        loader = Loader(engine, es, es_config=ES_CONFIG, max_rows=2,
+                        precreate_ahead=0, state_dir=self.tmpdir,
+                        cursor='time_window', window_sql='sql',
+                        window_overlap=0,
+                        window_start=datetime.date(2016, 11, 25))
+        self.assertIsNone(loader.gaps)
+        loader.initialise()
+        now = datetime.datetime(2016, 11, 26, 12, 0)
+        loader._load_windows(now)
+        self.assertEqual([q[1:3] for q in engine.queries],
+                [(datetime.datetime(2016, 11, 25),
+                    datetime.datetime(2016, 11, 26))] * 2 +
+                [(datetime.datetime(2016, 11, 26),
+                    datetime.datetime(2016, 11, 27))])
+        # Each bulk request writes to one daily index
+        self.assertEqual([set(a['index']['_index'] for a in r)
+                            for r in es.requests],
+                        [set(['test-25112016'])] * 2 +
+                        [set(['test-26112016'])])
+        self.assertEqual(loader.position.position,
+                        (row(4, 26, 1)['TIME_STAMP'], 4))
+
+        # Row 5 commits late, behind the checkpoint but within the overlap
+        engine.rows.append(row(5, 26, 0, 58))
+        loader.window_overlap = 300
+        loader._load_windows(now)
+        # Row 4 was loaded already, only row 5 is sent
+        self.assertEqual([a['index']['_id'] for a in es.requests[-1]], [5])
+        self.assertEqual(loader.seq, 5)
+        # Nothing new, nothing sent
+        requests = len(es.requests)
+        loader._load_windows(now)
+        self.assertEqual(len(es.requests), requests)
+        # The checkpoint doesn't move back and survives a restart
+        restarted = Loader(engine, es, es_config=ES_CONFIG,
+                            state_dir=self.tmpdir, cursor='time_window',
+                            window_sql='sql')
+        self.assertEqual(restarted.position.position,
+                        (row(4, 26, 1)['TIME_STAMP'], 4))
+        # and so do the rows loaded in the overlap
+        restarted._load_windows(now)
+        self.assertEqual(len(es.requests), requests)
+
+    def test_time_windows_carry_on_after_db_errors(self):
+        import sqlalchemy
+        class DroppedEngine(object):
+            def execute(self, sql, params):
+                raise sqlalchemy.exc.OperationalError(sql, params,
+                                                    Exception('dropped'))
+        loader = Loader(DroppedEngine(), FakeES(), es_config=ES_CONFIG,
+                        precreate_ahead=0, cursor='time_window',
+                        window_sql='sql',
+                        window_start=datetime.date(2016, 11, 25))
+        loader.position.advance(datetime.datetime(2016, 11, 25), -1)
+        self.assertTrue(loader._load_windows(
+                                datetime.datetime(2016, 11, 26, 12, 0)))
+
+    def test_gaps_within_the_first_page_are_tracked(self):
+        loader = Loader(FakeEngine(make_rows([1, 4, 5])), FakeES(),
+                        es_config=ES_CONFIG, sql=SQL, precreate_ahead=0)
+        loader.load()
+        self.assertEqual(list(loader.gaps), [(2, 3)])
+
+    def test_range_sql_keeps_table_prefix(self):
+        loader = self.make_loader(FakeES(), sql="SELECT TOP (?) * FROM [T] "
+                                "WHERE [T].[INSERT_SEQ] > ? ORDER BY 1")
+        self.assertEqual(loader._get_range_sql(loader.sql, 2),
+                "SELECT TOP (?) * FROM [T] WHERE ([T].[INSERT_SEQ] BETWEEN "
+                "? AND ? OR [T].[INSERT_SEQ] BETWEEN ? AND ?) ORDER BY 1")
+
+    def test_gaps_are_fetched_together_a_page_at_a_time(self):
+        es = FakeES()
+        engine = FakeEngine(make_rows([1, 5, 10]))
+        budget = MemoryBudget(10 ** 6)
+        loader = Loader(engine, es, es_config=ES_CONFIG, sql=SQL,
+                        max_rows=2, min_rows=1, precreate_ahead=0,
+                        memory_budget=budget)
+        loader.load()
+        self.assertEqual(list(loader.gaps), [(2, 4), (6, 9)])
+        engine.rows.extend(make_rows([2, 3, 7]))
+        engine.rows.sort(key=lambda r: r['INSERT_SEQ'])
+        del engine.queries[:]
+        del es.requests[:]
+        loader._fill_gaps()
+        self.assertEqual(list(loader.gaps), [(4, 4), (6, 6), (8, 9)])
+        # Both gaps in each query, carrying on after the last row found
+        self.assertEqual([q[1:] for q in engine.queries],
+                        [(2, 4, 6, 9), (4, 4, 6, 9)])
+        self.assertEqual([[a['index']['_id'] for a in r]
+                            for r in es.requests], [[2, 3], [7]])
+        self.assertEqual(budget.used, 0)
+
+    def test_reload_range_refreshes_dimensions(self):
+        class FakeEnricher(object):
+            refreshed = 0
+
+            def refresh_if_due(self):
+                self.refreshed += 1
+
+            def enrich(self, body):
+                body['CONSUMER_GROUP'] = 'rg%d' % self.refreshed
+                return body
+
+        enricher = FakeEnricher()
+        loader = Loader(FakeEngine(make_rows([1, 2])), FakeES(),
+                        es_config=ES_CONFIG, sql=SQL, enrichers=[enricher])
+        sent = []
+        loader._bulk = lambda inserts: (sent.extend(inserts), [])
+        loader.reload_range(1, 2)
+        self.assertEqual(enricher.refreshed, 1)
+        self.assertEqual([a['_source']['CONSUMER_GROUP'] for a in sent],
+                        ['rg1', 'rg1'])
+
+    def test_sinks_get_docs_but_not_rollups(self):
+        from ensemble.index_config.consumer_demand import config
+        rows = [dict(r, CONSUMER_NAME='/A/B', CLUSTER_NAME='c', USED=1)
+                for r in make_rows([1, 2])]
+        sink = RecordingSink()
+        loader = Loader(FakeEngine(rows), FakeES(), es_config=config,
+                        sql=SQL, precreate_ahead=0, rollup=True,
+                        gap_max_age=0, sinks=[sink])
+        sent = []
+        loader._bulk = lambda inserts: (sent.extend(inserts), [])
+        loader.load()
+        self.assertTrue(any(a['_index'].startswith('rollup_') for a in sent))
+        self.assertEqual([r['_index'] for r in sink.records],
+                        ['consumer_demand-25112016'] * 2)
+
+    def make_consumer_rows(self, used):
+        consumers = ['/A/X', '/A/Y', '/B/W', '/B/Z']
+        return [dict(make_rows([seq])[0], CONSUMER_NAME=consumers[seq - 1],
+                    CLUSTER_NAME='c', USED=used[seq])
+                for seq in sorted(used)]
+
+    def rollup_used(self, es):
+        return dict((doc['CONSUMER_PATH'], doc['USED'])
+                    for (index, _), doc in es.docs.iteritems()
+                    if index.startswith('rollup_'))
+
+    def test_rollup_sample_split_across_a_restart(self):
+        from ensemble.index_config.consumer_demand import config
+        es = FakeES()
+        engine = FakeEngine(self.make_consumer_rows({1: 1, 2: 2}))
+        loader = Loader(engine, es, es_config=config, sql=SQL, max_rows=10,
+                        precreate_ahead=0, rollup=True, gap_max_age=0)
+        loader.load()
+        self.assertEqual(self.rollup_used(es)['/'], 3)
+        # The rest of the sample turns up after a restart
+        engine.rows.extend(self.make_consumer_rows({3: 4}))
+        restarted = Loader(engine, es, es_config=config, sql=SQL,
+                            max_rows=10, precreate_ahead=0, rollup=True,
+                            gap_max_age=0)
+        restarted._find_last_seq = lambda index_name: 2
+        restarted.load()
+        self.assertEqual(self.rollup_used(es),
+                        {'/': 7, '/A': 3, '/A/X': 1, '/A/Y': 2, '/B': 4,
+                        '/B/W': 4})
+
+    def test_rollup_includes_backfilled_rows(self):
+        from ensemble.index_config.consumer_demand import config
+        es = FakeES()
+        engine = FakeEngine(self.make_consumer_rows({1: 1, 2: 2, 4: 8}))
+        loader = Loader(engine, es, es_config=config, sql=SQL, max_rows=10,
+                        precreate_ahead=0, rollup=True)
+        loader.load()
+        self.assertEqual(list(loader.gaps), [(3, 3)])
+        self.assertEqual(self.rollup_used(es)['/B'], 8)
+        # Row 3 commits late and is picked up from the gap
+        engine.rows.extend(self.make_consumer_rows({3: 4}))
+        engine.rows.sort(key=lambda r: r['INSERT_SEQ'])
+        loader.load()
+        self.assertEqual(list(loader.gaps), [])
+        self.assertEqual(self.rollup_used(es)['/B'], 12)
+        self.assertEqual(self.rollup_used(es)['/'], 15)
@@ -0,0 +1,33 @@
+import os
+from ensemble.profiler import LoaderProfiler
+from fakes import FakeLoader, TempDirTestCase
+
+class LoaderProfiler_test(TempDirTestCase):
+    def profile(self, mode, extension):
+        loader = FakeLoader('test')
+        profiler = LoaderProfiler(mode, iterations=2, output_dir=self.tmpdir)
+        profiler.request(['test'])
+        while profiler.wants(loader):
+            profiler.run(loader)
+        self.assertEqual(loader.loads, 2)
+        files = os.listdir(self.tmpdir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('test-'))
+        self.assertTrue(files[0].endswith(extension))
+        self.assertEqual(len(loader.logger.messages), 1)
+        self.assertIn('Profile of 2 iterations', loader.logger.messages[0])
+        return loader.logger.messages[0]
+
+    def test_cprofile_counts_down_and_writes_pstats(self):
+        summary = self.profile('cprofile', '.pstats')
+        self.assertIn('cumulative', summary)
+
+    def test_sampling_writes_collapsed_stacks(self):
+        summary = self.profile('sampling', '.collapsed')
+        self.assertIn('samples', summary)
+
+    def test_request_skips_unknown_loaders(self):
+        profiler = LoaderProfiler(output_dir=self.tmpdir)
+        profiler.request(['test', 'typo'], known=['test'])
+        self.assertTrue(profiler.wants(FakeLoader('test')))
+        self.assertFalse(profiler.wants(FakeLoader('typo')))
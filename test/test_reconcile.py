@@ -0,0 +1,55 @@
+import datetime
+import logging
+import unittest2 as unittest
+from ensemble.loader import Loader, ResourceMetricsLoader
+from ensemble.reconcile import compare, get_table, Reconciler
+from fakes import FakeEngine, FakeES
+
+DAY1 = datetime.date(2016, 11, 24)
+DAY2 = datetime.date(2016, 11, 25)
+DAY3 = datetime.date(2016, 11, 26)
+
+class Reconcile_test(unittest.TestCase):
+    def test_get_table(self):
+        self.assertEqual(get_table("SELECT TOP (?) [A] FROM "
+                    "[SYMPHONY].[dbo].[CONSUMER_DEMAND] WHERE [A] > ?"),
+                    "[SYMPHONY].[dbo].[CONSUMER_DEMAND]")
+        self.assertIsNone(get_table("SELECT 1"))
+
+    def test_compare(self):
+        db = {DAY2: (10, 1, 10), DAY3: (5, 11, 15)}
+        es = {DAY1: (3, -5, -3), DAY2: (9, 1, 10), DAY3: (5, 11, 15)}
+        self.assertEqual(compare(Loader, db, es),
+                ([(DAY2, (10, 1, 10), (9, 1, 10))], [DAY1]))
+
+    def test_compare_without_counts(self):
+        db = {DAY2: (10, 1, 10), DAY3: (5, 11, 15)}
+        es = {DAY2: (2, 1, 10)}
+        self.assertEqual(compare(ResourceMetricsLoader, db, es),
+                ([(DAY3, (5, 11, 15), None)], []))
+
+def make_es():
+    key = (DAY2 - datetime.date(1970, 1, 1)).days * 86400000
+    return FakeES(search_result={'aggregations': {'days': {'buckets': [
+                {'key': key, 'doc_count': 2, 'min_seq': {'value': 1},
+                    'max_seq': {'value': 2}}]}}})
+
+class FakeLoader(Loader):
+    def __init__(self):
+        self.name = 'test'
+        self.logger = logging.getLogger('Test')
+        self.sql = "SELECT TOP (?) * FROM [T] WHERE [INSERT_SEQ] > ?"
+        self.seq_field = 'INSERT_SEQ'
+        self.es_config = {'all_index': 'test'}
+        self.engine = FakeEngine(result=[{'DAY': DAY2, 'NUM_ROWS': 2,
+                                        'MIN_SEQ': 1, 'MAX_SEQ': 2}])
+        self.es = make_es()
+
+class Reconciler_test(unittest.TestCase):
+    def test_run_leaves_out_today(self):
+        loader = FakeLoader()
+        results = Reconciler([loader], days=2, today=DAY3).run()
+        self.assertEqual(results, {'test': ([], [])})
+        self.assertEqual(loader.engine.queries, [(DAY1, DAY3)])
+        self.assertEqual(loader.es.searches[0]['query']['range']['TIME_STAMP'],
+                        {'gte': DAY1.isoformat(), 'lt': DAY3.isoformat()})
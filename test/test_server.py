@@ -0,0 +1,117 @@
+import logging
+import os
+import time
+import yaml
+import unittest2 as unittest
+from ensemble import server
+from fakes import FakeLoader, TempDirTestCase
+
+def make_config(**loaders):
+    return {'setup': {'interval': 3600},
+            'loaders': dict((name, dict({'sql': 'sql'}, **conf))
+                            for name, conf in loaders.iteritems())}
+
+class ReloadConfig_test(TempDirTestCase):
+    def setUp(self):
+        super(ReloadConfig_test, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'config.yml')
+        self.created = []
+        self.get_loader = server.get_loader
+        server.get_loader = self.fake_get_loader
+        self.logger = logging.getLogger('Test')
+
+    def tearDown(self):
+        server.get_loader = self.get_loader
+        for w in server.workers.values():
+            w.stop()
+            w.join()
+        server.workers.clear()
+        super(ReloadConfig_test, self).tearDown()
+
+    def fake_get_loader(self, loadername, cfg, engine, es, logger,
+                        budget=None):
+        # The old loader must have finished before its replacement exists
+        old = server.workers.get(loadername)
+        self.assertFalse(old and old.is_alive())
+        loader = FakeLoader(loadername, cfg['loaders'][loadername]['sql'])
+        self.created.append(loader)
+        return loader
+
+    def start(self, cfg):
+        loaders = [self.fake_get_loader(name, cfg, None, None, self.logger)
+                    for name in cfg['loaders']]
+        server.run(loaders, cfg)
+
+    def reload(self, cfg, new_cfg):
+        with open(self.path, 'w') as f:
+            yaml.dump(new_cfg, f)
+        return server.reload_config(self.path, cfg, None, None, self.logger)
+
+    def test_sql_and_interval_change_in_place(self):
+        cfg = make_config(a={})
+        self.start(cfg)
+        worker = server.workers['a']
+        new_cfg = self.reload(cfg, make_config(a={'sql': 'new sql',
+                                                'interval': 60}))
+        self.assertIs(server.workers['a'], worker)
+        self.assertEqual(worker.loader.sql, 'new sql')
+        self.assertEqual(worker.interval, 60)
+        self.assertEqual(new_cfg['loaders']['a']['sql'], 'new sql')
+
+    def test_add_remove_and_recreate_loaders(self):
+        cfg = make_config(a={}, b={})
+        self.start(cfg)
+        old_a, old_b = server.workers['a'], server.workers['b']
+        self.reload(cfg, make_config(a={'rollup': True}, c={}))
+        self.assertEqual(sorted(server.workers), ['a', 'c'])
+        # b is stopped and closes its sinks once its load is done
+        self.assertTrue(old_b.loader.closed.wait(5))
+        # a is recreated after the old worker exits
+        self.assertIsNot(server.workers['a'], old_a)
+        self.assertFalse(old_a.is_alive())
+        self.assertTrue(old_a.loader.closed.is_set())
+        self.assertEqual([l.name for l in self.created],
+                        ['a', 'b', 'a', 'c'])
+
+    def test_recreate_joins_with_a_timeout(self):
+        cfg = make_config(a={})
+        self.start(cfg)
+        old = server.workers['a']
+        # Still closing when the reload starts
+        old.loader.close = lambda: time.sleep(0.2)
+        timeouts = []
+        join = old.join
+        def timed_join(timeout=None):
+            timeouts.append(timeout)
+            join(timeout)
+        old.join = timed_join
+        self.reload(cfg, make_config(a={'rollup': True}))
+        self.assertFalse(old.is_alive())
+        self.assertTrue(timeouts)
+        self.assertNotIn(None, timeouts)
+
+    def test_invalid_config_is_ignored(self):
+        cfg = make_config(a={})
+        self.start(cfg)
+        with open(self.path, 'w') as f:
+            f.write('loaders: [')
+        self.assertIs(server.reload_config(self.path, cfg, None, None,
+                                            self.logger), cfg)
+
+class Reconcile_test(unittest.TestCase):
+    def test_unknown_loaders_exit_non_zero(self):
+        args = server.parse_args(['--reconcile', 'a', 'typo'])
+        with self.assertRaises(SystemExit) as ctx:
+            server.reconcile([FakeLoader('a')], make_config(a={}), args)
+        self.assertIn('typo', str(ctx.exception.code))
+
+class Cleanup_test(unittest.TestCase):
+    def tearDown(self):
+        server.workers.clear()
+
+    def test_loaders_are_closed_once(self):
+        loaders = [FakeLoader('a'), FakeLoader('b')]
+        server.run(loaders, make_config(a={}, b={}))
+        with self.assertRaises(SystemExit):
+            server.cleanup()
+        self.assertEqual([l.closes for l in loaders], [1, 1])
@@ -0,0 +1,71 @@
+import datetime
+import gzip
+import json
+import os
+from ensemble.sinks import FileSink, get_sink
+from fakes import FlakySink, TempDirTestCase
+
+class Sink_test(TempDirTestCase):
+
+    def wait_for(self, sink, seq):
+        for _ in range(100):
+            if sink.checkpoint == seq:
+                return
+            sink.stopped.wait(0.05)
+        self.fail("checkpoint %s, expected %s" % (sink.checkpoint, seq))
+
+    def test_spools_when_full_and_writes_in_order(self):
+        sink = FlakySink('fake', 'loader', state_dir=self.tmpdir,
+                        max_pending=2, retry_wait=0.01)
+        sink.start()
+        for seq in range(1, 6):
+            sink.send([{'seq': seq}], seq)
+        self.assertTrue(os.path.isfile(sink.spool_path))
+        sink.ok.set()
+        self.wait_for(sink, 5)
+        sink.close()
+        self.assertEqual([r[0]['seq'] for r in sink.written], range(1, 6))
+        self.assertFalse(os.path.isfile(sink.draining_path))
+        # Checkpoint survives a restart
+        self.assertEqual(FlakySink('fake', 'loader',
+                                state_dir=self.tmpdir).checkpoint, 5)
+
+    def test_close_keeps_unwritten_batches(self):
+        sink = FlakySink('fake', 'loader', state_dir=self.tmpdir,
+                        retry_wait=0.01)
+        sink.start()
+        sink.send([{'seq': 1}], 1)
+        sink.send([{'seq': 2}], 2)
+        sink.close()
+        self.assertIsNone(sink.checkpoint)
+
+        restarted = FlakySink('fake', 'loader', state_dir=self.tmpdir,
+                            retry_wait=0.01)
+        restarted.ok.set()
+        restarted.start()
+        self.wait_for(restarted, 2)
+        restarted.close()
+        self.assertEqual(restarted.written, [[{'seq': 1}], [{'seq': 2}]])
+
+    def test_file_sink_writes_gzipped_json_lines(self):
+        path = os.path.join(self.tmpdir, 'lake')
+        sink = get_sink('loader', {'type': 'file', 'path': path})
+        self.assertIsInstance(sink, FileSink)
+        sink.write([{'_id': 1}])
+        sink.write([{'_id': 2}, {'_id': 3}])
+        filename = os.path.join(path, os.listdir(path)[0])
+        with gzip.open(filename) as f:
+            self.assertEqual([json.loads(l)['_id'] for l in f], [1, 2, 3])
+
+    def test_file_sink_files_docs_by_their_day(self):
+        path = os.path.join(self.tmpdir, 'lake')
+        sink = FileSink('file', 'loader', path=path)
+        sink.write([
+            {'_id': 1, '_source': {'TIME_STAMP':
+                                    datetime.datetime(2016, 11, 25, 23, 59)}},
+            # Spooled records come back with string timestamps
+            {'_id': 2, '_source': {'TIME_STAMP': '2016-11-26T00:01:00'}},
+        ])
+        self.assertEqual(sorted(os.listdir(path)),
+                        ['loader-20161125.jsonl.gz',
+                            'loader-20161126.jsonl.gz'])